@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, ttk, simpledialog, filedialog
@@ -6,6 +7,24 @@ from openai import OpenAI
 import unicodedata
 import re
 import threading
+import time
+import cProfile
+import pstats
+import io
+import tracemalloc
+import traceback
+import platform
+import mmap
+import codecs
+import shutil
+import tempfile
+import uuid
+import bisect
+import hashlib
+import heapq
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 
@@ -21,6 +40,17 @@ if API_KEY:
 CHAT_DIR = Path.home() / "Documents" / "chats"
 CHAT_DIR.mkdir(parents=True, exist_ok=True)
 
+# Approximate list prices in USD per 1M tokens as (input, output); only used for
+# the cost estimates shown in compare mode. Edit alongside the models list.
+MODEL_PRICING = {
+    "gpt-5-nano": (0.05, 0.40),
+    "gpt-5-mini": (0.25, 2.00),
+    "gpt-5": (1.25, 10.00),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+}
+
 # --- Text cleaning ---
 def clean_text_aggressive(text: str) -> str:
     text = unicodedata.normalize("NFKC", text)
@@ -30,9 +60,1809 @@ def clean_text_aggressive(text: str) -> str:
     text = re.sub(r"[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]", "", text)
     return text.strip()
 
+# --- API rate limiting ---
+PRIORITY_INTERACTIVE = 0   # turns the user is waiting on
+PRIORITY_BACKGROUND = 10   # title generation, indexing embeddings
+
+# Client-side limits per model as (requests per minute, tokens per minute).
+# Set these to your organisation's limits; unlisted models use DEFAULT_RATE_LIMIT.
+RATE_LIMITS = {
+    "gpt-5-nano": (500, 200_000),
+    "gpt-5-mini": (500, 200_000),
+    "gpt-5": (500, 30_000),
+    "gpt-4.1-nano": (500, 200_000),
+    "gpt-4.1-mini": (500, 200_000),
+    "gpt-4.1": (500, 30_000),
+    "text-embedding-3-small": (3000, 1_000_000),
+    "files": (100, 1_000_000),  # Files API uploads (PDF attachments); limited by requests only
+}
+DEFAULT_RATE_LIMIT = (500, 30_000)
+# Share of every bucket that background work leaves untouched for interactive turns
+BACKGROUND_RESERVE = 0.2
+
+def estimate_tokens(messages, completion_tokens=1000):
+    """Rough token count of a request for rate limiting: ~4 characters per token."""
+    chars = 0
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):  # content parts, e.g. expanded attachments
+            chars += sum(len(part.get("text", "")) for part in content)
+    return chars // 4 + 4 * len(messages) + completion_tokens
+
+class TokenBucket:
+    """Refills continuously at per_minute / 60 per second, up to per_minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, reserve, now):
+        """Seconds until amount can be taken while leaving reserve * capacity behind."""
+        self._refill(now)
+        amount = min(amount, self.capacity * (1 - reserve))  # oversized requests still get through
+        missing = amount + reserve * self.capacity - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount):
+        """Give back (positive) or charge extra (negative) once the real usage is known."""
+        self.level = min(self.capacity, self.level + amount)
+
+class ApiTicket:
+    """Permission for one API request, returned by ApiScheduler.acquire()."""
+
+    def __init__(self, scheduler, model, tokens, waited):
+        self.scheduler = scheduler
+        self.model = model
+        self.tokens = tokens
+        self.waited = waited
+
+    def settle(self, used_tokens):
+        """Correct the token bucket with the usage the API reported."""
+        if used_tokens is not None:
+            self.scheduler._adjust(self.model, self.tokens - used_tokens)
+
+class ApiScheduler:
+    """Central gate for all API traffic: per-model RPM/TPM token buckets plus priorities.
+
+    acquire() blocks the calling worker thread until its request may go out.
+    Requests for a model go in priority order, then first come first served.
+    Background requests also wait while any interactive request is queued, and
+    may not dip into the BACKGROUND_RESERVE share of a bucket.
+    """
+
+    def __init__(self, limits, default_limit, background_reserve):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.background_reserve = background_reserve
+        self._buckets = {}
+        self._waiting = []  # (priority, seq, model, enqueued_at)
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def _buckets_for(self, model):
+        if model not in self._buckets:
+            rpm, tpm = self.limits.get(model, self.default_limit)
+            self._buckets[model] = (TokenBucket(rpm), TokenBucket(tpm))
+        return self._buckets[model]
+
+    def _delay(self, waiter, tokens):
+        """Seconds until waiter may go, or None if it must wait for others first."""
+        priority, _seq, model, _enqueued = waiter
+        for other in self._waiting:
+            if other[:2] < waiter[:2] and (other[2] == model or other[0] < priority):
+                return None
+        reserve = self.background_reserve if priority > PRIORITY_INTERACTIVE else 0.0
+        requests, budget = self._buckets_for(model)
+        now = time.monotonic()
+        return max(requests.delay(1, reserve, now), budget.delay(tokens, reserve, now))
+
+    def acquire(self, model, tokens, priority=PRIORITY_INTERACTIVE):
+        with self._cond:
+            self._seq += 1
+            waiter = (priority, self._seq, model, time.monotonic())
+            self._waiting.append(waiter)
+            try:
+                while True:
+                    delay = self._delay(waiter, tokens)
+                    if delay is not None and delay <= 0:
+                        requests, budget = self._buckets_for(model)
+                        now = time.monotonic()
+                        requests.take(1, now)
+                        budget.take(tokens, now)
+                        break
+                    self._cond.wait(delay)
+            finally:
+                self._waiting.remove(waiter)
+                self._cond.notify_all()
+        return ApiTicket(self, model, tokens, time.monotonic() - waiter[3])
+
+    def _adjust(self, model, amount):
+        with self._cond:
+            self._buckets_for(model)[1].adjust(amount)
+            self._cond.notify_all()
+
+    def queue_state(self):
+        """(number of requests waiting, longest wait in seconds) for the UI."""
+        with self._cond:
+            now = time.monotonic()
+            return len(self._waiting), max((now - w[3] for w in self._waiting), default=0.0)
+
+api_scheduler = ApiScheduler(RATE_LIMITS, DEFAULT_RATE_LIMIT, BACKGROUND_RESERVE)
+
+# --- Message store ---
+# Messages are kept as slotted records rather than dicts. Contents above
+# LAZY_CONTENT_BYTES are not decoded at load time: their raw JSON string is
+# copied to content_spill, a temporary file private to this process, and
+# decoded on access. Chat files themselves are never kept open, since other
+# instances and programs may rewrite them at any time.
+LAZY_CONTENT_BYTES = 16 * 1024
+
+class ContentSpill:
+    """Append-only temporary file of raw JSON string tokens, shared by all lazy contents.
+
+    Identical tokens (the same long message in several chats) are stored once.
+    The file is deleted when the app exits.
+    """
+
+    def __init__(self):
+        self._file = None
+        self._spans = {}  # sha1 of token -> (offset, length)
+        self._lock = threading.Lock()
+
+    def add(self, token):
+        digest = hashlib.sha1(token).digest()
+        with self._lock:
+            span = self._spans.get(digest)
+            if span is None:
+                if self._file is None:
+                    self._file = tempfile.TemporaryFile(prefix="chat-contents-")
+                self._file.seek(0, os.SEEK_END)
+                span = (self._file.tell(), len(token))
+                self._file.write(token)
+                self._spans[digest] = span
+        return span
+
+    def read(self, offset, length):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+content_spill = ContentSpill()
+
+class LazyText:
+    """A JSON string token in content_spill, decoded on demand."""
+    __slots__ = ("offset", "length")
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+
+    def text(self):
+        return json.loads(content_spill.read(self.offset, self.length))
+
+class Message:
+    """One chat message. Supports the read-only dict access the rest of the app uses
+    (msg["role"], msg.get("attachment"), "attachment" in msg)."""
+    __slots__ = ("role", "_content", "extra")
+
+    def __init__(self, role, content, extra=None):
+        self.role = sys.intern(role)
+        self._content = content
+        self.extra = extra or None  # any other keys, e.g. "attachment"
+
+    @classmethod
+    def from_dict(cls, data):
+        extra = None
+        if len(data) > 2:
+            extra = {key: value for key, value in data.items() if key not in ("role", "content")}
+        return cls(data.get("role", ""), data.get("content", ""), extra)
+
+    @property
+    def content(self):
+        content = self._content
+        return content.text() if isinstance(content, LazyText) else content
+
+    @property
+    def size(self):
+        """Length of the content without decoding it (bytes of JSON for lazy contents)."""
+        content = self._content
+        return content.length if isinstance(content, LazyText) else len(content)
+
+    @property
+    def lazy_size(self):
+        """Bytes of this message kept in content_spill instead of memory."""
+        content = self._content
+        return content.length if isinstance(content, LazyText) else 0
+
+    def __getitem__(self, key):
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in ("role", "content") or bool(self.extra and key in self.extra)
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.role == other.role and self.extra == other.extra and self.content == other.content
+
+    def to_dict(self):
+        data = {"role": self.role, "content": self.content}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+def json_default(obj):
+    """json.dump hook that writes Message records as plain message objects."""
+    if isinstance(obj, Message):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+_CONTENT_KEY = b'"content": "'  # how json.dump(indent=2) writes a message content
+
+def _string_end(buf, start):
+    """End offset of the JSON string token whose opening quote is at start."""
+    pos = start
+    while True:
+        pos = buf.find(b'"', pos + 1)
+        if pos == -1:
+            raise ValueError(f"Unterminated string at byte {start}")
+        backslashes = 0
+        while buf[pos - 1 - backslashes] == 0x5C:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return pos + 1
+
+def _long_contents(data):
+    """(start, end) of message content tokens in data longer than LAZY_CONTENT_BYTES.
+
+    The gaps between "content" keys bound each content's length, so only
+    candidates need scanning for the closing quote.
+    """
+    spans = []
+    pos = data.find(_CONTENT_KEY)
+    while pos != -1:
+        start = pos + len(_CONTENT_KEY) - 1
+        pos = data.find(_CONTENT_KEY, start)
+        if (len(data) if pos == -1 else pos) - start > LAZY_CONTENT_BYTES:
+            end = _string_end(data, start)
+            if end - start > LAZY_CONTENT_BYTES:
+                spans.append((start, end))
+    return spans
+
+def _parse_spilled(data, spans):
+    """Parse chat JSON with the tokens at spans moved to content_spill; None if they
+    are not all message contents."""
+    nonce = uuid.uuid4().hex
+    pieces = []
+    last = 0
+    for i, (start, end) in enumerate(spans):
+        pieces += (data[last:start], b'"\\u0000%s%d"' % (nonce.encode(), i))
+        last = end
+    pieces.append(data[last:])
+    conversation = json.loads(b"".join(pieces))
+
+    marker = "\0" + nonce
+    found = []
+    for msg in conversation.get("messages", []) if isinstance(conversation, dict) else ():
+        content = msg.get("content") if isinstance(msg, dict) else None
+        if isinstance(content, str) and content.startswith(marker):
+            found.append((msg, int(content[len(marker):])))
+    if len(found) != len(spans):  # a "content" key outside a message
+        return None
+    for msg, i in found:
+        start, end = spans[i]
+        msg["content"] = LazyText(*content_spill.add(data[start:end]))
+    return conversation
+
+def load_chat_file(f):
+    """Parse a chat file opened in binary mode into a conversation of Message records."""
+    data = f.read()
+    spans = _long_contents(data) if len(data) > LAZY_CONTENT_BYTES else []
+    conversation = _parse_spilled(data, spans) if spans else None
+    if conversation is None:
+        text = data.decode("utf-8")
+        del data
+        conversation = json.loads(text)
+    conversation["messages"] = [Message.from_dict(m) if isinstance(m, dict) else m
+                                for m in conversation.get("messages", [])]
+    return conversation
+
+def iter_transcript(messages):
+    """Pieces of a plain-text transcript, for "".join() or file.writelines()."""
+    for msg in messages:
+        yield "You: " if msg["role"] == "user" else "AI: "
+        yield msg["content"]
+        yield "\n\n"
+
+# --- Conversation cache ---
+# Parsed chats kept in memory, measured by file size on disk less the contents spilled
+CONVERSATION_CACHE_BYTES = 64 * 1024 * 1024
+
+def copy_conversation_data(conversation):
+    """Copy of a conversation whose lists can be appended to without touching the original."""
+    return {key: list(value) if isinstance(value, list) else value for key, value in conversation.items()}
+
+class ConversationCache:
+    """Size-bounded LRU of parsed chat files, validated by mtime and size.
+
+    get() only re-reads a file when it changed on disk since it was cached.
+    Cached conversations are shared between callers; anything that modifies
+    one must take a copy_conversation_data() first.
+    """
+
+    def __init__(self, max_bytes=CONVERSATION_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # path -> (mtime_ns, size, cost, conversation)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._prefetch_paths = []
+        self._prefetch_wakeup = threading.Event()
+        self._prefetch_thread = None
+
+    def get(self, path):
+        path = os.fspath(path)
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[3]
+            self.misses += 1
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())  # describe the file we actually parse
+            conversation = load_chat_file(f)
+        self._store(path, conversation, st)
+        return conversation
+
+    def put(self, path, conversation, st=None):
+        """Cache a conversation just written to path (write-through after saving).
+
+        Pass st, the stat of the file as written, when another process may
+        rewrite path in the meantime.
+        """
+        path = os.fspath(path)
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return
+        self._store(path, copy_conversation_data(conversation), st)
+
+    def _store(self, path, conversation, st):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._bytes -= old[2]
+            cost = st.st_size - sum(msg.lazy_size for msg in conversation.get("messages", ())
+                                    if isinstance(msg, Message))
+            if cost > self.max_bytes:
+                return
+            self._entries[path] = (st.st_mtime_ns, st.st_size, cost, conversation)
+            self._bytes += cost
+            while self._bytes > self.max_bytes:
+                _path, (_mtime, _size, cost, _conversation) = self._entries.popitem(last=False)
+                self._bytes -= cost
+
+    def invalidate(self, path):
+        with self._lock:
+            old = self._entries.pop(os.fspath(path), None)
+            if old is not None:
+                self._bytes -= old[2]
+
+    def prefetch(self, paths):
+        """Load paths into the cache on a background thread; replaces any earlier request."""
+        with self._lock:
+            self._prefetch_paths = [os.fspath(path) for path in paths]
+            if self._prefetch_thread is None:
+                self._prefetch_thread = threading.Thread(target=self._prefetch_loop, daemon=True)
+                self._prefetch_thread.start()
+        self._prefetch_wakeup.set()
+
+    def _prefetch_loop(self):
+        while True:
+            self._prefetch_wakeup.wait()
+            self._prefetch_wakeup.clear()
+            while True:
+                with self._lock:
+                    if not self._prefetch_paths:
+                        break
+                    path = self._prefetch_paths.pop(0)
+                try:
+                    self.get(path)
+                except Exception:
+                    pass  # deleted or half-written; a real load will report it
+
+    def on_chat_changes(self, added, removed, modified):
+        """Watcher subscriber: free entries of deleted chats (get() catches edits by mtime)."""
+        for title in removed:
+            self.invalidate(os.path.join(CHAT_DIR, f"{title}.json"))
+
+conversation_cache = ConversationCache()
+
+# --- Safe chat writes ---
+# Several instances (or the app plus a sync tool) may share CHAT_DIR. Saves are
+# written to a temp file and renamed into place, so readers never see a partial
+# file and need no lock. The read-check-write of a save runs under an advisory
+# lock, and each file carries a version number so a stale instance cannot
+# silently overwrite newer messages.
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+INSTANCE_ID = uuid.uuid4().hex[:12]
+LOCK_DIR = CHAT_DIR / ".locks"
+SAVE_DELAY_MS = 300  # saves requested within this window become one write
+
+@contextmanager
+def chat_file_lock(path):
+    """Hold an advisory exclusive lock for a chat file (shared by all instances)."""
+    LOCK_DIR.mkdir(exist_ok=True)
+    with open(LOCK_DIR / (os.path.basename(path) + ".lock"), "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def try_exclusive_lock(f):
+    """Take an advisory exclusive lock on open file f without waiting; False if it is held."""
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+def write_json_atomic(path, data):
+    """Write JSON to a temp file in the same folder, fsync it, then rename it over path.
+
+    Returns the os.stat_result of the file as written, taken before the rename
+    so that it cannot describe a later write by someone else.
+    """
+    path = os.fspath(path)
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{INSTANCE_ID}.tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2, default=json_default)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+        os.replace(tmp_path, path)
+        return st
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class ChatWriter:
+    """Background writer that coalesces saves and checks versions before writing.
+
+    schedule() records the latest snapshot of a conversation; it is written
+    SAVE_DELAY_MS after the first request, so a burst of saves costs one disk
+    write. Under the chat's lock the writer compares the version on disk with
+    the one the snapshot was based on:
+    - same version: write version + 1
+    - another instance appended to a chat we only extended: write ours on top
+    - the file on disk already contains everything we have: keep it ("adopted")
+    - the histories diverged: keep theirs and write ours as a conflict copy
+    on_saved(title, outcome, version, new_title) is called on the Tk thread.
+    """
+
+    def __init__(self, chat_dir, on_saved, delay_ms=SAVE_DELAY_MS):
+        self.chat_dir = Path(chat_dir)
+        self.on_saved = on_saved
+        self.delay = delay_ms / 1000
+        self._pending = {}     # title -> (due, conversation snapshot)
+        self._writing = set()  # titles taken off _pending by _run and not written yet
+        self._versions = {}    # title -> version this instance last wrote itself
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule(self, conversation):
+        with self._cond:
+            title = conversation["title"]
+            due = self._pending[title][0] if title in self._pending else time.monotonic() + self.delay
+            self._pending[title] = (due, conversation)
+            self._cond.notify()
+
+    def cancel(self, title):
+        """Drop a pending save, e.g. before the chat is renamed or deleted.
+
+        Waits for a write of the chat that is already under way, so the file
+        cannot reappear after the caller removes it.
+        """
+        with self._cond:
+            self._pending.pop(title, None)
+            while title in self._writing:
+                self._cond.wait()
+
+    def flush(self):
+        """Write everything pending now, on the calling thread."""
+        with self._cond:
+            while self._writing:  # let older snapshots land first
+                self._cond.wait()
+            pending, self._pending = self._pending, {}
+        for _due, conversation in pending.values():
+            self._write(conversation)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    ready = [title for title, (due, _c) in self._pending.items() if due <= now]
+                    if ready:
+                        break
+                    timeout = min((due for due, _c in self._pending.values()), default=now + 3600) - now
+                    self._cond.wait(timeout)
+                snapshots = [self._pending.pop(title)[1] for title in ready]
+                self._writing.update(ready)
+            for title, conversation in zip(ready, snapshots):
+                try:
+                    self._write(conversation)
+                finally:
+                    with self._cond:
+                        self._writing.discard(title)
+                        self._cond.notify_all()
+
+    def _write(self, conversation):
+        title = conversation["title"]
+        path = self.chat_dir / f"{title}.json"
+        try:
+            with self._write_lock, chat_file_lock(path):
+                outcome, version, new_title = self._write_locked(path, conversation)
+        except Exception as e:
+            print(f"Error saving: {e}")
+            return
+        if outcome in ("saved", "conflict"):
+            # Tk variables may only be read on the Tk thread, so the index is updated there
+            def index_saved_chat(name=new_title or title, messages=conversation["messages"]):
+                if semantic_index_enabled():
+                    get_semantic_index().enqueue(name, messages)
+            ui_queue.post(index_saved_chat)
+        ui_queue.post(lambda: self.on_saved(title, outcome, version, new_title))
+
+    def _write_locked(self, path, conversation):
+        title = conversation["title"]
+        base = max(conversation.get("version", 0), self._versions.get(title, 0))
+        disk = conversation_cache.get(path) if path.exists() else None
+        disk_version = disk.get("version", 0) if disk else 0
+        ours = conversation["messages"]
+
+        if disk is not None and disk_version > base:
+            theirs = disk.get("messages", [])
+            if theirs[:len(ours)] == ours:
+                return "adopted", disk_version, None
+            if ours[:len(theirs)] != theirs:
+                new_title = f"{title}_conflict_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+                conversation.update(title=new_title, version=1, saved_by=INSTANCE_ID)
+                conflict_path = self.chat_dir / f"{new_title}.json"
+                conversation_cache.put(conflict_path, conversation, write_json_atomic(conflict_path, conversation))
+                self._versions[new_title] = 1
+                return "conflict", 1, new_title
+            base = disk_version  # ours extends theirs: safe to write on top
+
+        conversation.update(version=base + 1, saved_by=INSTANCE_ID)
+        # Cache with the stat of what we wrote, taken under the lock: a stat
+        # taken later could describe another instance's newer file
+        conversation_cache.put(path, conversation, write_json_atomic(path, conversation))
+        self._versions[title] = base + 1
+        return "saved", base + 1, None
+
+# --- Attachments ---
+# Attached files are stored once, by content hash, and conversations only keep a
+# reference, so chat files stay small however big the attachment is.
+ATTACHMENT_DIR = CHAT_DIR / "attachments"
+ATTACHMENT_READ_BYTES = 4 * 1024 * 1024  # read/hash files in blocks of this size
+ATTACHMENT_CHUNK_TOKENS = 2000           # each text chunk sent as one content part
+ATTACHMENT_MAX_TOKENS = 100_000          # text sent per attachment; the rest is cut off
+UPLOAD_EXTENSIONS = {".pdf"}             # sent as file uploads instead of text
+_attachment_parts_cache = OrderedDict()
+_attachment_parts_lock = threading.Lock()
+
+def format_size(num_bytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if num_bytes < 1024 or unit == "GB":
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+
+def attachment_path(attachment):
+    return ATTACHMENT_DIR / (attachment["sha256"] + Path(attachment["name"]).suffix.lower())
+
+def prepare_attachment(path):
+    """Hash, store and describe a file to attach. Runs on a worker thread.
+
+    The file is hashed through a memory map in ATTACHMENT_READ_BYTES blocks and
+    copied into ATTACHMENT_DIR under its hash unless an identical file is
+    already there. PDFs are uploaded to the API; other files must be text.
+    """
+    path = Path(path)
+    size = path.stat().st_size
+    suffix = path.suffix.lower()
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if not size:
+            raise ValueError("The file is empty")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if suffix not in UPLOAD_EXTENSIONS and b"\0" in mm[:8192]:
+                raise ValueError("Only text files and PDFs can be attached")
+            with memoryview(mm) as view:
+                for start in range(0, size, ATTACHMENT_READ_BYTES):
+                    digest.update(view[start:start + ATTACHMENT_READ_BYTES])
+    attachment = {"name": path.name, "sha256": digest.hexdigest(), "size": size}
+
+    stored = attachment_path(attachment)
+    if not stored.exists():
+        ATTACHMENT_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = stored.with_name(stored.name + ".tmp")
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, stored)
+
+    if suffix in UPLOAD_EXTENSIONS:
+        if client is None:
+            raise RuntimeError("Set an API key before attaching PDFs")
+        api_scheduler.acquire("files", 0, PRIORITY_INTERACTIVE)
+        with open(stored, "rb") as f:
+            attachment["file_id"] = client.files.create(file=(path.name, f), purpose="user_data").id
+    return attachment
+
+def chunk_text_file(path, chunk_chars, max_chars):
+    """Split a UTF-8 text file into chunks of about chunk_chars, preferring line breaks.
+
+    Reads in blocks so only one block plus one chunk is decoded at a time.
+    Returns (chunks, truncated).
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    chunks, buffer, total = [], "", 0
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(ATTACHMENT_READ_BYTES)
+            buffer += decoder.decode(block, final=not block)
+            pos = 0
+            while len(buffer) - pos >= chunk_chars or (not block and pos < len(buffer)):
+                end = min(pos + chunk_chars, len(buffer))
+                if end < len(buffer):
+                    newline = buffer.rfind("\n", pos + chunk_chars // 2, end)
+                    if newline != -1:
+                        end = newline + 1
+                chunks.append(buffer[pos:end])
+                total += end - pos
+                pos = end
+                if total >= max_chars:
+                    # Only cut off if text is left in the buffer, the decoder or the file
+                    more = pos < len(buffer) or decoder.getstate()[0] or (block and f.read(1))
+                    return chunks, bool(more)
+            buffer = buffer[pos:]
+            if not block:
+                return chunks, False
+
+def attachment_content_parts(attachment):
+    """API content parts for an attachment message (cached per file).
+
+    Called from several worker threads at once (compare mode); the lock is
+    held while a file is chunked so it is only read once.
+    """
+    with _attachment_parts_lock:
+        cached = _attachment_parts_cache.get(attachment["sha256"])
+        if cached is not None:
+            _attachment_parts_cache.move_to_end(attachment["sha256"])
+            return cached
+        parts = _build_attachment_parts(attachment)
+        if parts is not None:
+            _attachment_parts_cache[attachment["sha256"]] = parts
+            if len(_attachment_parts_cache) > 8:
+                _attachment_parts_cache.popitem(last=False)
+        else:
+            parts = [{"type": "text", "text": f"[Attached file {attachment['name']} is no longer available]"}]
+        return parts
+
+def _build_attachment_parts(attachment):
+    """Content parts for attachment, or None if its stored copy is gone."""
+    name = attachment["name"]
+    if "file_id" in attachment:
+        parts = [{"type": "text", "text": f"Attached file: {name}"},
+                 {"type": "file", "file": {"file_id": attachment["file_id"]}}]
+    else:
+        stored = attachment_path(attachment)
+        if not stored.exists():
+            return None
+        chunks, truncated = chunk_text_file(stored, ATTACHMENT_CHUNK_TOKENS * 4, ATTACHMENT_MAX_TOKENS * 4)
+        parts = [{"type": "text", "text": f"Attached file: {name} (part {i} of {len(chunks)})\n\n{chunk}"}
+                 for i, chunk in enumerate(chunks, 1)]
+        if truncated:
+            parts.append({"type": "text", "text": f"[{name} was cut off after {ATTACHMENT_MAX_TOKENS} tokens]"})
+    return parts
+
+def to_api_messages(messages):
+    """Conversation messages as the API expects them, with attachments expanded."""
+    api_messages = []
+    for msg in messages:
+        attachment = msg.get("attachment")
+        content = attachment_content_parts(attachment) if attachment else msg["content"]
+        api_messages.append({"role": msg["role"], "content": content})
+    return api_messages
+
+# --- Chat folder watching ---
+# watchdog is optional: it gives us inotify/FSEvents/ReadDirectoryChanges
+# notifications. Without it we fall back to polling CHAT_DIR.
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+# How a pending change combines with a newer one for the same chat.
+# None means the two cancel out (created and deleted within one batch).
+_CHANGE_MERGE = {
+    ("added", "added"): "added",
+    ("added", "modified"): "added",
+    ("added", "removed"): None,
+    ("removed", "added"): "modified",
+    ("removed", "modified"): "modified",
+    ("removed", "removed"): "removed",
+    ("modified", "added"): "modified",
+    ("modified", "modified"): "modified",
+    ("modified", "removed"): "removed",
+}
+
+class _ChatDirEventHandler(FileSystemEventHandler):
+    """Forward watchdog events for *.json files to a ChatDirWatcher."""
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._forward(event.src_path, "added")
+
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self._forward(event.src_path, "removed")
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._forward(event.src_path, "modified")
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._forward(event.src_path, "removed")
+            self._forward(event.dest_path, "added")
+
+    def _forward(self, path, kind):
+        name = os.path.basename(os.fsdecode(path))
+        if name.endswith(".json"):
+            self.watcher.notify(name[:-5], kind)
+
+class ChatDirWatcher:
+    """Report chats added, removed or modified in CHAT_DIR by anyone.
+
+    Changes are coalesced per chat title and delivered to subscribers as one
+    batch, on the Tk thread, at most once per flush_delay_ms. Subscribers are
+    called as callback(added, removed, modified) with sets of chat titles.
+    """
+
+    def __init__(self, directory, schedule, flush_delay_ms=250, poll_interval=1.0):
+        self.directory = Path(directory)
+        self.schedule = schedule  # schedule(delay_ms, fn) on the Tk thread, e.g. ui_queue.post_later
+        self.flush_delay_ms = flush_delay_ms
+        self.poll_interval = poll_interval
+        self._listeners = []
+        self._pending = {}
+        self._flush_scheduled = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._observer = None
+        self._snapshot = {}
+        self._known = set()  # chats currently on disk, as far as events have told us
+
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+
+    def start(self):
+        self._snapshot = self._scan()
+        self._known = set(self._snapshot)
+        if Observer is not None:
+            try:
+                self._observer = Observer()
+                self._observer.schedule(_ChatDirEventHandler(self), str(self.directory), recursive=False)
+                self._observer.start()
+                return
+            except Exception as e:
+                print(f"Chat folder notifications unavailable, polling instead: {e}")
+                self._observer = None
+        threading.Thread(target=self._poll_loop, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+
+    def notify(self, name, kind):
+        """Record a change; safe to call from any thread."""
+        with self._lock:
+            # A file created or renamed over an existing chat (atomic saves,
+            # sync tools) replaces it: that is a modification, not a new chat
+            if kind == "added" and name in self._known:
+                kind = "modified"
+            if kind == "removed":
+                self._known.discard(name)
+            else:
+                self._known.add(name)
+            previous = self._pending.get(name)
+            merged = kind if previous is None else _CHANGE_MERGE[(previous, kind)]
+            if merged is None:
+                self._pending.pop(name, None)
+            else:
+                self._pending[name] = merged
+            if self._flush_scheduled or not self._pending:
+                return
+            self._flush_scheduled = True
+        self.schedule(self.flush_delay_ms, self._flush)
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flush_scheduled = False
+        if not pending:
+            return
+        changes = {"added": set(), "removed": set(), "modified": set()}
+        for name, kind in pending.items():
+            changes[kind].add(name)
+        for callback in self._listeners:
+            try:
+                callback(changes["added"], changes["removed"], changes["modified"])
+            except Exception as e:
+                print(f"Error handling chat folder changes: {e}")
+
+    def _scan(self):
+        snapshot = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".json") and entry.is_file():
+                        st = entry.stat()
+                        snapshot[entry.name[:-5]] = (st.st_mtime_ns, st.st_size)
+        except OSError as e:
+            print(f"Error scanning chat folder: {e}")
+        return snapshot
+
+    def _poll_loop(self):
+        while not self._stop.wait(self.poll_interval):
+            previous, current = self._snapshot, self._scan()
+            self._snapshot = current
+            for name in current.keys() - previous.keys():
+                self.notify(name, "added")
+            for name in previous.keys() - current.keys():
+                self.notify(name, "removed")
+            for name, signature in current.items():
+                if name in previous and previous[name] != signature:
+                    self.notify(name, "modified")
+
+# --- Semantic index ---
+# NumPy is optional; without it the semantic index is unavailable.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Kept next to CHAT_DIR rather than inside it so index files never show up as chats
+INDEX_DIR = CHAT_DIR.parent / "chats_index"
+EMBEDDING_PROVIDER = os.getenv("CHAT_EMBEDDING_PROVIDER", "openai")
+CONTEXT_SNIPPETS = 4      # excerpts injected when "Use related chats" is on
+SNIPPET_CHARS = 600       # max characters per injected excerpt
+
+class OpenAIEmbeddingProvider:
+    """Embeddings from the OpenAI API; needs an API key and network access."""
+    name = "openai:text-embedding-3-small"
+    dim = 1536
+    max_chars = 8000
+
+    def embed(self, texts, priority=PRIORITY_BACKGROUND):
+        if client is None:
+            raise RuntimeError("No API key set")
+        inputs = [text[:self.max_chars] for text in texts]
+        ticket = api_scheduler.acquire("text-embedding-3-small", sum(len(text) for text in inputs) // 4, priority)
+        response = client.embeddings.create(model="text-embedding-3-small", input=inputs)
+        ticket.settle(response.usage.total_tokens)
+        return np.array([item.embedding for item in response.data], dtype=np.float32)
+
+class HashingEmbeddingProvider:
+    """Offline stand-in that hashes words into a fixed-size vector.
+
+    Needs no model or network, but only matches shared vocabulary, not meaning.
+    """
+    name = "hashing-1024"
+    dim = 1024
+
+    def embed(self, texts, priority=PRIORITY_BACKGROUND):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                h = zlib.crc32(word.encode("utf-8"))
+                vectors[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return vectors
+
+# Any object with name, dim and embed(list_of_texts, priority) -> float32 array works here,
+# e.g. a wrapper around a local sentence-transformers model.
+EMBEDDING_PROVIDERS = {
+    "openai": OpenAIEmbeddingProvider,
+    "hashing": HashingEmbeddingProvider,
+}
+
+_FROM_DISK = object()  # enqueue() marker: re-read the chat from its file
+
+def _normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+class IndexInUseError(RuntimeError):
+    """Another instance owns the semantic index."""
+
+class SemanticIndex:
+    """Per-message embeddings in a memory-mapped matrix with top-k cosine search.
+
+    vectors.<n>.f32 holds one L2-normalised float32 row per message. index.json
+    is a snapshot of what each row belongs to (chat, message index, role,
+    content hash) and index.<n>.log an append-only journal of changes since the
+    snapshot. Rows of deleted or edited messages are tombstoned; their vectors
+    are reused when the same content shows up again (e.g. after a rename) and
+    dropped when the file is compacted.
+
+    index.json names the vectors file and journal it belongs to, and replacing
+    it is the one step that commits a new snapshot or compaction. Files it does
+    not name are leftovers of an interrupted snapshot and are removed on load.
+
+    The index files are not safe to share, so the first instance to open the
+    index holds owner.lock until it exits; others get IndexInUseError.
+    """
+
+    def __init__(self, directory, chat_dir, provider):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._owner_file = open(self.directory / "owner.lock", "a+b")
+        if not try_exclusive_lock(self._owner_file):
+            self._owner_file.close()
+            raise IndexInUseError("The semantic index is in use by another window")
+        self.chat_dir = Path(chat_dir)
+        self.provider = provider
+        self.dim = provider.dim
+        self.lock = threading.RLock()
+        self.snapshot_path = self.directory / "index.json"
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._load()
+
+    # Storage
+
+    def _load(self):
+        snapshot, log_lines = None, []
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            # Snapshots from before generations were added use fixed file names
+            log_path = self.directory / snapshot.get("log", "index.log")
+            if os.path.exists(log_path):
+                with open(log_path, "r", encoding="utf-8") as f:
+                    log_lines = f.readlines()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Semantic index unreadable, rebuilding: {e}")
+            snapshot = None
+        fresh = not snapshot or snapshot.get("provider") != self.provider.name or snapshot.get("dim") != self.dim
+        if fresh:
+            snapshot, log_lines = {"rows": [], "chats": {}, "matrix": "vectors.0.f32", "log": "index.0.log"}, []
+        self.generation = snapshot.get("generation", 0)
+        self.matrix_path = self.directory / snapshot.get("matrix", "vectors.f32")
+        self.log_path = self.directory / snapshot.get("log", "index.log")
+        for path in self.directory.iterdir():
+            if re.fullmatch(r"vectors(\.\d+)?\.f32|index(\.\d+)?\.log", path.name) \
+                    and (fresh or path not in (self.matrix_path, self.log_path)):
+                os.remove(path)
+
+        self.rows = [list(row) for row in snapshot["rows"]]  # [chat, msg, role, hash]
+        self.chat_state = snapshot["chats"]                   # chat -> [message count, file mtime_ns]
+        for line in log_lines:
+            try:
+                self._apply(json.loads(line))
+            except ValueError:
+                break  # torn last line from a crash
+        self._rebuild_lookups()
+        self._open_matrix(max(len(self.rows), 1024))
+        self._log = open(self.log_path, "a", encoding="utf-8")
+        if fresh:
+            self._write_snapshot()
+
+    def _apply(self, entry):
+        op = entry["op"]
+        if op == "add":
+            while len(self.rows) <= entry["row"]:
+                self.rows.append([None, 0, "", ""])
+            self.rows[entry["row"]] = [entry["chat"], entry["msg"], entry["role"], entry["hash"]]
+        elif op == "kill":
+            self.rows[entry["row"]][0] = None
+        elif op == "chat":
+            if entry["state"] is None:
+                self.chat_state.pop(entry["chat"], None)
+            else:
+                self.chat_state[entry["chat"]] = entry["state"]
+
+    def _journal(self, entries):
+        for entry in entries:
+            self._apply(entry)
+        self._log.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+        self._log.flush()
+
+    def _rebuild_lookups(self):
+        self._by_chat = {}
+        self._by_hash = {}
+        for i, (chat, msg, role, content_hash) in enumerate(self.rows):
+            self._by_hash[content_hash] = i
+            if chat is not None:
+                self._by_chat.setdefault(chat, {})[msg] = i
+
+    def _open_matrix(self, capacity, path=None):
+        if path is not None:
+            self.matrix_path = path
+        row_bytes = self.dim * 4
+        with open(self.matrix_path, "a+b") as f:
+            f.seek(0, os.SEEK_END)
+            capacity = max(capacity, f.tell() // row_bytes)
+            if f.tell() < capacity * row_bytes:
+                f.truncate(capacity * row_bytes)
+        self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self.alive = np.zeros(capacity, dtype=bool)
+        for i, row in enumerate(self.rows):
+            self.alive[i] = row[0] is not None
+
+    def _ensure_capacity(self, needed):
+        if needed <= self.matrix.shape[0]:
+            return
+        self.matrix.flush()
+        del self.matrix
+        self._open_matrix(max(needed, self.alive.shape[0] * 2))
+
+    def _write_snapshot(self):
+        """Commit the current state as the next generation, with an empty journal."""
+        self.matrix.flush()
+        generation = self.generation + 1
+        log_path = self.directory / f"index.{generation}.log"
+        new_log = open(log_path, "w", encoding="utf-8")
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"provider": self.provider.name, "dim": self.dim, "generation": generation,
+                       "matrix": self.matrix_path.name, "log": log_path.name,
+                       "rows": self.rows, "chats": self.chat_state}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self._log.close()
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self._log, self.log_path, self.generation = new_log, log_path, generation
+
+    def _compact(self):
+        """Rewrite the live rows into a new vectors file; the old one stays valid until
+        the snapshot naming the new one is committed."""
+        keep = [i for i, row in enumerate(self.rows) if row[0] is not None]
+        vectors = np.array(self.matrix[keep]) if keep else np.zeros((0, self.dim), dtype=np.float32)
+        self.rows = [self.rows[i] for i in keep]
+        old_path = self.matrix_path
+        self.matrix.flush()
+        del self.matrix
+        self._open_matrix(max(len(self.rows) * 2, 1024), self.directory / f"vectors.{self.generation + 1}.f32")
+        self.matrix[:len(self.rows)] = vectors
+        self._rebuild_lookups()
+        self._write_snapshot()
+        os.remove(old_path)
+
+    def _maybe_compact(self):
+        dead = len(self.rows) - int(self.alive[:len(self.rows)].sum())
+        if dead > 1024 and dead > len(self.rows) // 2:
+            self._compact()
+        elif self._log.tell() > 8 * 1024 * 1024:
+            self._write_snapshot()
+
+    # Updates
+
+    def update_chat(self, title, messages):
+        """Index new or edited messages of a chat and drop rows for removed ones."""
+        wanted = {}
+        for i, msg in enumerate(messages):
+            content = msg.get("content")
+            if msg.get("role") in ("user", "assistant") and isinstance(content, str) and content.strip():
+                wanted[i] = (msg["role"], content, hashlib.sha1(content.encode("utf-8")).hexdigest())
+
+        with self.lock:
+            current = self._by_chat.get(title, {})
+            entries = [{"op": "kill", "row": row} for msg, row in current.items()
+                       if msg not in wanted or self.rows[row][3] != wanted[msg][2]]
+            missing = [msg for msg in wanted if msg not in current or self.rows[current[msg]][3] != wanted[msg][2]]
+            reused = {msg: self._by_hash[wanted[msg][2]] for msg in missing if wanted[msg][2] in self._by_hash}
+        to_embed = [msg for msg in missing if msg not in reused]
+
+        # Embedding may hit the network, so do it outside the lock
+        vectors = []
+        for start in range(0, len(to_embed), 64):
+            batch = to_embed[start:start + 64]
+            vectors.append(_normalize_rows(self.provider.embed([wanted[msg][1] for msg in batch])))
+        vectors = np.concatenate(vectors) if vectors else np.zeros((0, self.dim), dtype=np.float32)
+
+        with self.lock:
+            first = len(self.rows)
+            self._ensure_capacity(first + len(missing))
+            embedded = {msg: vectors[i] for i, msg in enumerate(to_embed)}
+            for offset, msg in enumerate(missing):
+                row = first + offset
+                self.matrix[row] = embedded[msg] if msg in embedded else self.matrix[reused[msg]]
+                self.alive[row] = True
+                role, _content, content_hash = wanted[msg]
+                entries.append({"op": "add", "row": row, "chat": title, "msg": msg, "role": role, "hash": content_hash})
+            for entry in entries:
+                if entry["op"] == "kill":
+                    self.alive[entry["row"]] = False
+            entries.append({"op": "chat", "chat": title, "state": [len(messages), self._chat_mtime(title)]})
+            self.matrix.flush()
+            self._journal(entries)
+            self._rebuild_lookups()
+            self._maybe_compact()
+
+    def remove_chat(self, title):
+        with self.lock:
+            entries = [{"op": "kill", "row": row} for row in self._by_chat.get(title, {}).values()]
+            for entry in entries:
+                self.alive[entry["row"]] = False
+            entries.append({"op": "chat", "chat": title, "state": None})
+            self._journal(entries)
+            self._rebuild_lookups()
+            self._maybe_compact()
+
+    def _chat_mtime(self, title):
+        try:
+            return os.stat(self.chat_dir / f"{title}.json").st_mtime_ns
+        except OSError:
+            return None
+
+    def enqueue(self, title, messages=_FROM_DISK):
+        """Queue a background re-index of a chat. messages=None removes it.
+
+        Pass the in-memory message list after saving, or leave the default to
+        re-read the chat file (for changes made by other programs).
+        """
+        with self._pending_lock:
+            if messages is _FROM_DISK and isinstance(self._pending.get(title), list):
+                return  # an in-memory copy is already queued and is at least as fresh
+            self._pending[title] = messages if messages in (None, _FROM_DISK) else list(messages)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                with self._pending_lock:
+                    if not self._pending:
+                        break
+                    title = next(iter(self._pending))
+                    messages = self._pending.pop(title)
+                try:
+                    self._process(title, messages)
+                except Exception as e:
+                    print(f"Semantic index update failed for {title}: {e}")
+
+    def _process(self, title, messages):
+        if messages is None:
+            self.remove_chat(title)
+            return
+        state = self.chat_state.get(title)
+        if messages is _FROM_DISK:
+            if state and state[1] == self._chat_mtime(title):
+                return
+            path = self.chat_dir / f"{title}.json"
+            if not path.exists():
+                self.remove_chat(title)
+                return
+            messages = conversation_cache.get(path).get("messages", [])
+        elif state and state[0] == len(messages):
+            # Autosave of an unchanged chat: only remember the new file time
+            with self.lock:
+                self._journal([{"op": "chat", "chat": title, "state": [len(messages), self._chat_mtime(title)]}])
+            return
+        self.update_chat(title, messages)
+
+    # Queries
+
+    def search(self, query, k=5, exclude_chat=None, priority=PRIORITY_INTERACTIVE):
+        """Top-k messages by cosine similarity to query, best first.
+
+        priority is passed on to the query embedding; searches normally have
+        a user waiting on them, unlike the background indexing.
+        """
+        q = _normalize_rows(self.provider.embed([query], priority))[0]
+        with self.lock:
+            n = len(self.rows)
+            if n == 0:
+                return []
+            scores = self.matrix[:n] @ q
+            scores[~self.alive[:n]] = -np.inf
+            if exclude_chat is not None:
+                for row in self._by_chat.get(exclude_chat, {}).values():
+                    scores[row] = -np.inf
+            k = min(k, int(np.isfinite(scores).sum()))
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [{"score": float(scores[i]), "chat": self.rows[i][0], "msg": self.rows[i][1],
+                     "role": self.rows[i][2], "hash": self.rows[i][3]} for i in top]
+
+    def message_text(self, result):
+        """Current text of a search hit, or None if the chat changed since indexing."""
+        try:
+            conversation = conversation_cache.get(self.chat_dir / f"{result['chat']}.json")
+            content = conversation["messages"][result["msg"]]["content"]
+        except (OSError, ValueError, KeyError, IndexError):
+            return None
+        if hashlib.sha1(content.encode("utf-8")).hexdigest() != result["hash"]:
+            return None
+        return content
+
+semantic_index = None
+
+def get_semantic_index():
+    """The shared SemanticIndex, created on first use.
+
+    None if NumPy is missing or another instance owns the index.
+    """
+    global semantic_index
+    if semantic_index is None and np is not None:
+        provider = EMBEDDING_PROVIDERS.get(EMBEDDING_PROVIDER, HashingEmbeddingProvider)()
+        try:
+            semantic_index = SemanticIndex(INDEX_DIR, CHAT_DIR, provider)
+        except IndexInUseError as e:
+            print(f"Semantic index unavailable: {e}")
+    return semantic_index
+
+# --- UI update queue ---
+class UiQueue:
+    """Thread-safe queue of UI updates, drained by the Tk loop on a frame budget.
+
+    Worker threads must not touch widgets, so they post callables here instead
+    of calling root.after themselves. Every frame_ms the Tk loop runs queued
+    updates until budget_ms is used up and leaves the rest for the next frame.
+
+    - post(fn, key): a pending update with the same key is replaced, keeping its
+      place in line. Use keys for "set state" updates such as status text or a
+      list refresh, where only the latest one matters.
+    - post_append(key, fn, text): text for a pending update with the same key is
+      concatenated, so a burst of streamed chunks becomes one fn(text) call.
+    - post_later(delay_ms, fn, key): like post, after a delay.
+    """
+
+    def __init__(self, frame_ms=16, budget_ms=8):
+        self.frame_ms = frame_ms
+        self.budget_ms = budget_ms
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._keyed = {}
+        self._timed = []
+        self._seq = 0
+        self.root = None
+        self.observer = None  # observer(fn, duration_ms) per task, set by Diagnostics
+
+    def post(self, fn, key=None):
+        with self._lock:
+            self._enqueue(fn, key)
+
+    def post_append(self, key, fn, text):
+        with self._lock:
+            entry = self._keyed.get(key)
+            if entry is not None and entry[2] is not None:
+                entry[2].append(text)
+            else:
+                self._enqueue(fn, key, [text])
+
+    def post_later(self, delay_ms, fn, key=None):
+        with self._lock:
+            self._seq += 1
+            heapq.heappush(self._timed, (time.monotonic() + delay_ms / 1000, self._seq, fn, key))
+
+    def _enqueue(self, fn, key, parts=None):
+        # Entry: [key, fn, text parts for post_append or None]
+        if key is not None and key in self._keyed:
+            self._keyed[key][1] = fn
+            return
+        entry = [key, fn, parts]
+        self._queue.append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+
+    def start(self, tk_root):
+        self.root = tk_root
+        self._drain()
+
+    def pending(self):
+        with self._lock:
+            return len(self._queue) + len(self._timed)
+
+    def _drain(self):
+        deadline = time.perf_counter() + self.budget_ms / 1000
+        with self._lock:
+            now = time.monotonic()
+            while self._timed and self._timed[0][0] <= now:
+                _due, _seq, fn, key = heapq.heappop(self._timed)
+                self._enqueue(fn, key)
+        while True:
+            with self._lock:
+                if not self._queue:
+                    break
+                key, fn, parts = self._queue.popleft()
+                if key is not None:
+                    del self._keyed[key]
+            started = time.perf_counter()
+            try:
+                if parts is None:
+                    fn()
+                else:
+                    fn("".join(parts))
+            except Exception as e:
+                print(f"UI update failed: {e}")
+            if self.observer is not None:
+                self.observer(fn, (time.perf_counter() - started) * 1000)
+            if time.perf_counter() >= deadline:
+                break
+        self.root.after(self.frame_ms, self._drain)
+
+ui_queue = UiQueue()
+
+# --- Markdown rendering ---
+_MD_HEADING = re.compile(r"^(#{1,6})\s+(.*)$")
+_MD_LIST = re.compile(r"^(\s*)([-*+]|\d+[.)])\s+(.*)$")
+_MD_QUOTE = re.compile(r"^\s*>\s?(.*)$")
+_MD_INLINE = re.compile(r"(`[^`\n]+`|\*\*[^*\n]+\*\*|\*[^*\s][^*\n]*\*)")
+
+_SYNTAX = re.compile(r"""
+    (?P<comment>\#[^\n]*|//[^\n]*|/\*.*?\*/)
+  | (?P<string>\"\"\".*?\"\"\"|'''.*?'''|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<number>\b\d+(?:\.\d+)?\b)
+  | (?P<keyword>\b(?:and|as|async|await|break|case|class|const|continue|def|elif|else|except|export|
+        false|False|finally|fn|for|from|func|function|if|impl|import|in|interface|is|lambda|let|match|
+        new|None|not|null|or|pass|pub|raise|return|self|static|struct|switch|this|throw|true|True|try|
+        type|use|var|void|while|with|yield)\b)
+""", re.VERBOSE | re.DOTALL)
+
+SYNTAX_MAX_CHARS = 200_000  # larger code blocks are shown without highlighting
+_highlight_cache = OrderedDict()
+_HIGHLIGHT_CACHE_SIZE = 256
+
+def highlight_spans(lang, code):
+    """Syntax tag ranges for a code block as {tag: [line1, col1, line2, col2, ...]}.
+
+    Lines are 0-based relative to the block. Results are cached per block
+    content, so re-rendering a chat does not re-tokenize its code.
+    """
+    key = hashlib.sha1(f"{lang}\0{code}".encode("utf-8")).digest()
+    cached = _highlight_cache.get(key)
+    if cached is not None:
+        _highlight_cache.move_to_end(key)
+        return cached
+    spans = {}
+    if len(code) <= SYNTAX_MAX_CHARS:
+        line_starts = [0] + [m.end() for m in re.finditer("\n", code)]
+        for m in _SYNTAX.finditer(code):
+            start_line = bisect.bisect_right(line_starts, m.start()) - 1
+            end_line = bisect.bisect_right(line_starts, m.end()) - 1
+            spans.setdefault("syn_" + m.lastgroup, []).extend(
+                (start_line, m.start() - line_starts[start_line], end_line, m.end() - line_starts[end_line]))
+    _highlight_cache[key] = spans
+    if len(_highlight_cache) > _HIGHLIGHT_CACHE_SIZE:
+        _highlight_cache.popitem(last=False)
+    return spans
+
+class MarkdownRenderer:
+    """Incremental Markdown rendering into a Tk Text widget.
+
+    feed() renders only the complete lines in the new text. The unfinished
+    last line is shown as plain text and re-rendered once its newline arrives,
+    so a streamed reply costs O(delta) per chunk. Consecutive text with the
+    same tags goes in as one insert, and code blocks are highlighted once, when
+    their closing fence arrives. The caller manages the widget's state.
+    """
+
+    def __init__(self, widget):
+        self.widget = widget
+        self.base_tag = "ai"
+        self.chars = 0
+        self.seconds = 0.0
+        self._reset()
+
+    def _reset(self):
+        self._partial = []
+        self._tail_open = False
+        self._run = []
+        self._run_tags = None
+        self._code = None
+        self._code_lang = ""
+        self._code_line = 0
+
+    def begin(self, base_tag="ai"):
+        """Start rendering a new message at the end of the widget."""
+        self._reset()
+        self.base_tag = base_tag
+        self.chars = 0
+        self.seconds = 0.0
+
+    def feed(self, text):
+        started = time.perf_counter()
+        if "\n" not in text:
+            # Still inside the same line: just extend the plain-text tail
+            self._show_tail(text)
+        else:
+            self._clear_tail()
+            first, *rest = text.split("\n")
+            self._partial.append(first)
+            self._render_line("".join(self._partial))
+            self._partial = [rest.pop()]
+            for line in rest:
+                self._render_line(line)
+            self._flush_run()
+            self._show_tail(self._partial[0], remember=False)
+        self.chars += len(text)
+        self.seconds += time.perf_counter() - started
+
+    def finish(self):
+        """Render the last line and close any open code block."""
+        started = time.perf_counter()
+        self._clear_tail()
+        last = "".join(self._partial)
+        if last:
+            self._render_line(last, end="")
+        if self._code is not None:
+            self._close_code_block()
+        self._flush_run()
+        self._reset()
+        self.seconds += time.perf_counter() - started
+
+    def render(self, text, base_tag="ai"):
+        """Render a complete message in one go."""
+        self.begin(base_tag)
+        self.feed(text)
+        self.finish()
+
+    # Tail (unfinished line)
+
+    def _show_tail(self, text, remember=True):
+        if remember:
+            self._partial.append(text)
+        if not text:
+            return
+        if not self._tail_open:
+            self.widget.mark_set("md_tail", "end-1c")
+            self.widget.mark_gravity("md_tail", tk.LEFT)
+            self._tail_open = True
+        tags = (self.base_tag, "md_code") if self._code is not None else (self.base_tag,)
+        self.widget.insert(tk.END, text, tags)
+
+    def _clear_tail(self):
+        if self._tail_open:
+            self.widget.delete("md_tail", "end-1c")
+            self._tail_open = False
+
+    # Line rendering
+
+    def _emit(self, text, tags):
+        if tags != self._run_tags:
+            self._flush_run()
+            self._run_tags = tags
+        self._run.append(text)
+
+    def _flush_run(self):
+        if self._run:
+            self.widget.insert(tk.END, "".join(self._run), self._run_tags)
+            self._run = []
+
+    def _inline(self, text, tags):
+        for i, part in enumerate(_MD_INLINE.split(text)):
+            if i % 2 == 0:
+                if part:
+                    self._emit(part, tags)
+            elif part.startswith("`"):
+                self._emit(part[1:-1], tags + ("md_inline_code",))
+            elif part.startswith("**"):
+                self._emit(part[2:-2], tags + ("md_bold",))
+            else:
+                self._emit(part[1:-1], tags + ("md_italic",))
+
+    def _render_line(self, line, end="\n"):
+        base = self.base_tag
+        fence = line.lstrip().startswith("```")
+        if self._code is not None:
+            if fence:
+                self._close_code_block()
+            else:
+                self._code.append(line)
+                self._emit(line + end, (base, "md_code"))
+            return
+        if fence:
+            self._open_code_block(line.strip()[3:].strip())
+            return
+        m = _MD_HEADING.match(line)
+        if m:
+            self._emit(m.group(2) + end, (base, f"md_h{min(len(m.group(1)), 3)}"))
+            return
+        m = _MD_LIST.match(line)
+        if m:
+            indent, marker, rest = m.groups()
+            tags = (base, "md_list")
+            self._emit(indent + ("•" if marker in "-*+" else marker) + " ", tags)
+            self._inline(rest, tags)
+            self._emit(end, tags)
+            return
+        m = _MD_QUOTE.match(line)
+        if m:
+            self._inline(m.group(1), (base, "md_quote"))
+            self._emit(end, (base, "md_quote"))
+            return
+        self._inline(line, (base,))
+        self._emit(end, (base,))
+
+    def _open_code_block(self, lang):
+        self._flush_run()
+        if not self.widget.index("end-1c").endswith(".0"):
+            self.widget.insert(tk.END, "\n", self.base_tag)
+        self._code = []
+        self._code_lang = lang
+        self._code_line = int(self.widget.index("end-1c").split(".")[0])
+
+    def _close_code_block(self):
+        self._flush_run()
+        spans = highlight_spans(self._code_lang, "\n".join(self._code))
+        first = self._code_line
+        for tag, coords in spans.items():
+            ranges = []
+            for i in range(0, len(coords), 4):
+                ranges.append(f"{first + coords[i]}.{coords[i + 1]}")
+                ranges.append(f"{first + coords[i + 2]}.{coords[i + 3]}")
+            # tag_add takes any number of ranges: one Tcl call per tag
+            self.widget.tag_add(tag, *ranges)
+        self._code = None
+
+# --- Diagnostics ---
+def describe_callable(fn):
+    """Readable name for a callback, with its source location for lambdas and closures."""
+    fn = getattr(fn, "__func__", fn)
+    name = getattr(fn, "__qualname__", None) or repr(fn)
+    code = getattr(fn, "__code__", None)
+    if code is not None:
+        return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return name
+
+class Diagnostics:
+    """Opt-in tools for finding out why the UI stutters.
+
+    - cProfile of the Tk (main) thread, switched on and off from the menu
+    - tracemalloc snapshots, each compared with the one before
+    - an event-loop lag monitor: a heartbeat measures how late the Tk loop
+      runs scheduled callbacks. Callbacks scheduled with root.after or posted to
+      the UI queue are timed, and a watcher thread grabs the main thread's
+      stack during a stall, so each stall is reported with the call behind it.
+    - save_report() writes all of it to a folder
+    """
+
+    def __init__(self, tk_root, queue):
+        self.root = tk_root
+        self.queue = queue
+        self.profiler = None
+        self.snapshots = []          # (label, tracemalloc snapshot)
+        self.stalls = deque(maxlen=200)
+        self.stall_threshold_ms = 100
+        self.heartbeat_ms = 50
+        self.monitoring = False
+        self._original_after = None
+        self._expected = None
+        self._worst = None           # (duration_ms, name) of the slowest callback since the last beat
+        self._stall_stack = None
+
+    # Profiling
+
+    def toggle_profiler(self, enabled):
+        if enabled:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()  # called from a menu command, so this profiles the Tk thread
+        elif self.profiler is not None:
+            self.profiler.disable()
+
+    def profile_text(self, limit=60):
+        if self.profiler is None:
+            return "Profiler was not run.\n"
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    # Memory
+
+    def take_snapshot(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+        snapshot = tracemalloc.take_snapshot()
+        self.snapshots.append((datetime.now().strftime("%H:%M:%S"), snapshot))
+        del self.snapshots[:-10]
+        current, peak = tracemalloc.get_traced_memory()
+        return len(self.snapshots), current, peak
+
+    def memory_text(self, limit=30):
+        if not self.snapshots:
+            return "No memory snapshots taken.\n"
+        lines = []
+        label, latest = self.snapshots[-1]
+        lines.append(f"Top allocations at {label}:")
+        lines.extend(str(stat) for stat in latest.statistics("lineno")[:limit])
+        for (old_label, old), (new_label, new) in zip(self.snapshots, self.snapshots[1:]):
+            lines.append(f"\nGrowth {old_label} -> {new_label}:")
+            lines.extend(str(stat) for stat in new.compare_to(old, "lineno")[:limit])
+        return "\n".join(lines) + "\n"
+
+    # Event-loop lag
+
+    def toggle_monitor(self, enabled):
+        if enabled and not self.monitoring:
+            self.monitoring = True
+            self._original_after = self.root.after
+            self.root.after = self._timed_after  # shadows Misc.after on this instance only
+            self.queue.observer = self._observe
+            self._expected = None
+            self._beat()
+            threading.Thread(target=self._watch_main_thread, daemon=True).start()
+        elif not enabled and self.monitoring:
+            self.monitoring = False
+            del self.root.after
+            self.queue.observer = None
+
+    def _timed_after(self, ms, func=None, *args):
+        if func is None or func == self.queue._drain:
+            return self._original_after(ms, func, *args)  # the queue reports its own tasks
+        name = describe_callable(func)
+
+        def timed(*call_args):
+            started = time.perf_counter()
+            try:
+                return func(*call_args)
+            finally:
+                self._observe(name, (time.perf_counter() - started) * 1000)
+
+        return self._original_after(ms, timed, *args)
+
+    def _observe(self, name, duration_ms):
+        if not isinstance(name, str):
+            name = describe_callable(name)
+        if self._worst is None or duration_ms > self._worst[0]:
+            self._worst = (duration_ms, name)
+
+    def _beat(self):
+        if not self.monitoring:
+            return
+        now = time.perf_counter()
+        if self._expected is not None:
+            lag_ms = (now - self._expected) * 1000
+            if lag_ms >= self.stall_threshold_ms:
+                self._record_stall(lag_ms)
+        self._worst = None
+        self._stall_stack = None
+        self._expected = now + self.heartbeat_ms / 1000
+        self._original_after(self.heartbeat_ms, self._beat)
+
+    def _record_stall(self, lag_ms):
+        if self._worst is not None and self._worst[0] >= lag_ms / 2:
+            culprit = f"{self._worst[1]} took {self._worst[0]:.0f} ms"
+        elif self._stall_stack:
+            culprit = "stack: " + self._stall_stack[-1]
+        else:
+            culprit = "unknown (event handler, redraw or untracked callback)"
+        self.stalls.append((datetime.now().strftime("%H:%M:%S.%f")[:-3], lag_ms, culprit, self._stall_stack))
+        set_status(f"UI stalled {lag_ms:.0f} ms: {culprit}", "orange", clear_after=5000)
+
+    def _watch_main_thread(self):
+        """Capture the main thread's stack while the Tk loop is overdue."""
+        main_id = threading.main_thread().ident
+        while self.monitoring:
+            time.sleep(self.stall_threshold_ms / 2000)
+            expected = self._expected
+            if expected is None or self._stall_stack is not None:
+                continue
+            if (time.perf_counter() - expected) * 1000 >= self.stall_threshold_ms / 2:
+                frame = sys._current_frames().get(main_id)
+                if frame is not None:
+                    self._stall_stack = [line.strip().replace("\n", " | ") for line in traceback.format_stack(frame)]
+
+    def stalls_text(self):
+        if not self.stalls:
+            return "No stalls recorded" + ("" if self.monitoring else " (monitor was not running)") + ".\n"
+        lines = []
+        for when, lag_ms, culprit, stack in self.stalls:
+            lines.append(f"{when}  {lag_ms:.0f} ms  {culprit}")
+            if stack:
+                lines.extend("    " + frame for frame in stack)
+        return "\n".join(lines) + "\n"
+
+    # Report
+
+    def save_report(self, folder):
+        """Write a diagnostics bundle into a new subfolder of folder and return its path."""
+        bundle = Path(folder) / datetime.now().strftime("diagnostics_%Y-%m-%d_%H-%M-%S")
+        bundle.mkdir(parents=True)
+        waiting, longest = api_scheduler.queue_state()
+        summary = [
+            f"Python: {sys.version}",
+            f"Platform: {platform.platform()}",
+            f"Tk: {self.root.tk.call('info', 'patchlevel')}",
+            f"Chats folder: {CHAT_DIR}",
+            f"Conversation cache: {len(conversation_cache._entries)} chats, {conversation_cache._bytes} bytes, "
+            f"{conversation_cache.hits} hits / {conversation_cache.misses} misses",
+            f"UI queue pending: {self.queue.pending()}",
+            f"API queue: {waiting} waiting, longest {longest:.1f}s",
+            f"Threads: {', '.join(t.name for t in threading.enumerate())}",
+            f"Stalls recorded: {len(self.stalls)} (threshold {self.stall_threshold_ms} ms)",
+        ]
+        (bundle / "summary.txt").write_text("\n".join(summary) + "\n", encoding="utf-8")
+        (bundle / "stalls.txt").write_text(self.stalls_text(), encoding="utf-8")
+        (bundle / "memory.txt").write_text(self.memory_text(), encoding="utf-8")
+        (bundle / "profile.txt").write_text(self.profile_text(), encoding="utf-8")
+        if self.profiler is not None:
+            self.profiler.dump_stats(str(bundle / "profile.pstats"))
+        return bundle
+
 # --- Functions ---
 current_conversation = None
 is_processing = False
+pending_attachments = []  # prepared attachments waiting to go out with the next message
 
 def set_api_key():
     """Open dialog to set OpenAI API key"""
@@ -97,7 +1927,6 @@ def set_api_key():
     button_frame.pack(fill=tk.X, padx=20, pady=20)
     
     def save_api_key():
-        global client, API_KEY
         new_key = api_key_var.get().strip()
         
         # If showing masked key and user didn't change it, don't update
@@ -120,69 +1949,90 @@ def set_api_key():
             status_label.config(foreground="red")
             return
         
+        # Test the key with a minimal API call off the Tk thread; the rate
+        # limiter may hold it back for a while and the UI must stay responsive
+        status_var.set("Checking API key...")
+        status_label.config(foreground="black")
+        save_btn.config(state=tk.DISABLED)
+        threading.Thread(target=validate_api_key, args=(new_key,), daemon=True).start()
+
+    def validate_api_key(new_key):
         try:
-            # Test the API key by creating a client
             test_client = OpenAI(api_key=new_key)
+            test_messages = [{"role": "user", "content": "Hi"}]
+            ticket = api_scheduler.acquire("gpt-5-mini", estimate_tokens(test_messages, 1), PRIORITY_INTERACTIVE)
+            try:
+                test_response = test_client.chat.completions.create(
+                    model="gpt-5-mini",
+                    messages=test_messages,
+                    max_tokens=1
+                )
+            except Exception:
+                ticket.settle(0)
+                raise
+            ticket.settle(test_response.usage.total_tokens if test_response.usage else None)
+        except Exception as e:
+            error_msg = str(e)
+            ui_queue.post(lambda: api_key_rejected(error_msg))
+            return
+        ui_queue.post(lambda: api_key_accepted(new_key, test_client))
+
+    def api_key_rejected(error_msg):
+        if not dialog.winfo_exists():
+            return
+        save_btn.config(state=tk.NORMAL)
+        status_var.set(f"⚠ Invalid API key: {error_msg[:50]}...")
+        status_label.config(foreground="red")
+
+    def api_key_accepted(new_key, test_client):
+        global client, API_KEY
+        API_KEY = new_key
+        client = test_client
+        
+        # Set environment variable for current session
+        os.environ["OPENAI_API_KEY"] = new_key
+        
+        # Try to save to a .env file for persistence
+        try:
+            env_file = ".env"
+            env_content = ""
             
-            # Try a minimal API call to validate the key
-            test_response = test_client.chat.completions.create(
-                model="gpt-5-mini",
-                messages=[{"role": "user", "content": "Hi"}],
-                max_tokens=1
-            )
+            # Read existing .env file if it exists
+            if os.path.exists(env_file):
+                with open(env_file, "r") as f:
+                    lines = f.readlines()
+                
+                # Update existing OPENAI_API_KEY line or keep other lines
+                updated = False
+                for i, line in enumerate(lines):
+                    if line.strip().startswith("OPENAI_API_KEY="):
+                        lines[i] = f"OPENAI_API_KEY={new_key}\n"
+                        updated = True
+                        break
+                
+                if updated:
+                    env_content = "".join(lines)
+                else:
+                    env_content = "".join(lines) + f"OPENAI_API_KEY={new_key}\n"
+            else:
+                env_content = f"OPENAI_API_KEY={new_key}\n"
             
-            # If we get here, the key works
-            API_KEY = new_key
-            client = test_client
+            # Write the .env file
+            with open(env_file, "w") as f:
+                f.write(env_content)
             
-            # Set environment variable for current session
-            os.environ["OPENAI_API_KEY"] = new_key
+            message, color, close_after = "✓ API key saved successfully!", "green", 1500
             
-            # Try to save to a .env file for persistence
-            try:
-                env_file = ".env"
-                env_content = ""
-                
-                # Read existing .env file if it exists
-                if os.path.exists(env_file):
-                    with open(env_file, "r") as f:
-                        lines = f.readlines()
-                    
-                    # Update existing OPENAI_API_KEY line or keep other lines
-                    updated = False
-                    for i, line in enumerate(lines):
-                        if line.strip().startswith("OPENAI_API_KEY="):
-                            lines[i] = f"OPENAI_API_KEY={new_key}\n"
-                            updated = True
-                            break
-                    
-                    if updated:
-                        env_content = "".join(lines)
-                    else:
-                        env_content = "".join(lines) + f"OPENAI_API_KEY={new_key}\n"
-                else:
-                    env_content = f"OPENAI_API_KEY={new_key}\n"
-                
-                # Write the .env file
-                with open(env_file, "w") as f:
-                    f.write(env_content)
-                
-                status_var.set("✓ API key saved successfully!")
-                status_label.config(foreground="green")
-                
-                # Close dialog after short delay
-                dialog.after(1500, dialog.destroy)
-                
-            except Exception as e:
-                # Even if .env save fails, we still have it for this session
-                status_var.set("✓ API key set for this session (couldn't save to .env file)")
-                status_label.config(foreground="orange")
-                print(f"Couldn't save to .env file: {e}")
-                dialog.after(2000, dialog.destroy)
-                
         except Exception as e:
-            status_var.set(f"⚠ Invalid API key: {str(e)[:50]}...")
-            status_label.config(foreground="red")
+            # Even if .env save fails, we still have it for this session
+            message, color, close_after = "✓ API key set for this session (couldn't save to .env file)", "orange", 2000
+            print(f"Couldn't save to .env file: {e}")
+        
+        if dialog.winfo_exists():
+            status_var.set(message)
+            status_label.config(foreground=color)
+            # Close dialog after short delay
+            dialog.after(close_after, dialog.destroy)
     
     def clear_api_key():
         global client, API_KEY
@@ -239,17 +2089,21 @@ def generate_chat_title(prompt_text):
         ("gpt-5-mini", {"temperature": 0.3}),
         ("gpt-4.1-mini", {"temperature": 0.3})
     ]
+    messages = [
+        {"role": "system", "content": "Create a short, descriptive 3-5 word title for this chat based on the user's message. Respond only with the title, no quotes or extra text."},
+        {"role": "user", "content": prompt_text}
+    ]
     for model, params in models_to_try:
         try:
+            # Background work: yields to interactive turns under the rate limits
+            ticket = api_scheduler.acquire(model, estimate_tokens(messages, 20), PRIORITY_BACKGROUND)
             response = client.chat.completions.create(
                 model=model,
-                messages=[
-                    {"role": "system", "content": "Create a short, descriptive 3-5 word title for this chat based on the user's message. Respond only with the title, no quotes or extra text."},
-                    {"role": "user", "content": prompt_text}
-                ],
+                messages=messages,
                 max_tokens=20,
                 **params
             )
+            ticket.settle(response.usage.total_tokens if response.usage else None)
             title = response.choices[0].message.content.strip()
             if title:
                 title = re.sub(r"[\r\n]+", " ", title).strip().strip('"').strip("'")
@@ -286,6 +2140,12 @@ def send_prompt_async():
         return
     
     is_processing = True
+    attachments = pending_attachments[:]
+    pending_attachments.clear()
+    update_attachments_label()
+    # Tk variables may only be read on the Tk thread, so settle these before starting the worker
+    model_name = model_var.get()
+    context_index = get_semantic_index() if context_var.get() and semantic_index_enabled() else None
     
     # Update UI immediately
     send_button.config(state="disabled", text="Sending...")
@@ -296,6 +2156,8 @@ def send_prompt_async():
     
     # Add user message to display immediately
     output_box.config(state=tk.NORMAL)
+    for attachment in attachments:
+        output_box.insert(tk.END, f"You: {attachment_placeholder(attachment)}\n", "user")
     output_box.insert(tk.END, f"You: {cleaned_input}\n", "user")
     output_box.insert(tk.END, "AI: Thinking...\n", "thinking")
     output_box.config(state=tk.DISABLED)
@@ -307,28 +2169,79 @@ def send_prompt_async():
             if not current_conversation:
                 start_new_conversation()
 
-            current_conversation["messages"].append({"role": "user", "content": cleaned_input})
-            user_count = sum(1 for m in current_conversation["messages"] if m.get("role") == "user")
+            # Attachments are stored by reference; the placeholder is what saves and exports show
+            for attachment in attachments:
+                current_conversation["messages"].append(
+                    Message("user", attachment_placeholder(attachment), {"attachment": attachment}))
+            current_conversation["messages"].append(Message("user", cleaned_input))
+            user_count = sum(1 for m in current_conversation["messages"] if m.get("role") == "user" and "attachment" not in m)
             is_first_user_message = (user_count == 1)
 
-            model_name = model_var.get()
-            response = client.chat.completions.create(
+            request_messages = to_api_messages(
+                build_request_messages(current_conversation["messages"], cleaned_input, context_index))
+            ticket = api_scheduler.acquire(model_name, estimate_tokens(request_messages), PRIORITY_INTERACTIVE)
+            stream = client.chat.completions.create(
                 model=model_name,
-                messages=current_conversation["messages"]
+                messages=request_messages,
+                stream=True,
+                stream_options={"include_usage": True}
             )
-            reply = response.choices[0].message.content
-            current_conversation["messages"].append({"role": "assistant", "content": reply})
+            parts = []
+            for chunk in stream:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        ui_queue.post_append("reply", stream_reply_delta, delta)
+                if getattr(chunk, "usage", None):
+                    ticket.settle(chunk.usage.total_tokens)
+            reply = "".join(parts)
+            current_conversation["messages"].append(Message("assistant", reply))
 
             # Update UI in main thread
-            root.after(0, lambda: update_ui_after_response(reply, cleaned_input, is_first_user_message))
+            ui_queue.post(lambda: update_ui_after_response(reply, cleaned_input, is_first_user_message))
 
         except Exception as e:
             # Handle errors in main thread; include original cleaned input so we can restore it
-            root.after(0, lambda: handle_api_error(str(e), cleaned_input))
+            error_msg = str(e)
+            ui_queue.post(lambda: handle_api_error(error_msg, cleaned_input, attachments))
 
     # Start the API call in a separate thread
     threading.Thread(target=api_call, daemon=True).start()
 
+# Replies at least this long report their render throughput in the status bar
+RENDER_STATS_MIN_CHARS = 1_000_000
+reply_streaming = False
+
+def stream_reply_delta(text):
+    """Render the next streamed chunk of the reply."""
+    global reply_streaming
+    output_box.config(state=tk.NORMAL)
+    if not reply_streaming:
+        # Replace the "AI: Thinking..." line with the start of the reply
+        output_box.delete("end-2l", "end-1c")
+        output_box.insert(tk.END, "AI: ", "ai")
+        reply_renderer.begin("ai")
+        reply_streaming = True
+    reply_renderer.feed(text)
+    output_box.config(state=tk.DISABLED)
+    output_box.see(tk.END)
+
+def finish_reply_stream():
+    global reply_streaming
+    if not reply_streaming:
+        return
+    output_box.config(state=tk.NORMAL)
+    reply_renderer.finish()
+    output_box.config(state=tk.DISABLED)
+    reply_streaming = False
+    report_render_throughput(reply_renderer.chars, reply_renderer.seconds)
+
+def report_render_throughput(chars, seconds):
+    if chars >= RENDER_STATS_MIN_CHARS and seconds > 0:
+        mb = chars / 1_000_000
+        set_status(f"Rendered {mb:.1f} MB in {seconds:.2f}s ({mb / seconds:.1f} MB/s)", "blue", clear_after=5000)
+
 def update_ui_after_response(reply, user_input, is_first_user_message):
     global is_processing
     
@@ -336,30 +2249,35 @@ def update_ui_after_response(reply, user_input, is_first_user_message):
     prompt_entry.config(state="normal")  # Enable first
     prompt_entry.delete("1.0", tk.END)
     
-    # Remove "Thinking..." line and add real response
+    # Nothing streamed (empty reply): still replace the "Thinking..." line
+    if not reply_streaming:
+        stream_reply_delta(reply)
+    finish_reply_stream()
     output_box.config(state=tk.NORMAL)
-    # Remove the last "AI: Thinking..." line
-    output_box.delete("end-2l", "end-1c")
-    output_box.insert(tk.END, f"AI: {reply}\n\n", "ai")
+    output_box.insert(tk.END, "\n\n", "ai")
     output_box.config(state=tk.DISABLED)
     output_box.see(tk.END)
 
     # Handle renaming for first message
     if is_first_user_message:
-        def generate_title_async():
-            title = generate_chat_title(user_input)
-            root.after(0, lambda: handle_title_generated(title))
-        
-        threading.Thread(target=generate_title_async, daemon=True).start()
+        start_title_generation(user_input)
     else:
         save_current_conversation()
-        refresh_chat_list()
+        request_chat_list_refresh()
 
     # Re-enable controls
     send_button.config(state="normal", text="Send")
     prompt_entry.focus_set()
     is_processing = False
 
+def start_title_generation(user_input):
+    """Generate a title for the first exchange in the background, then save/rename."""
+    def generate_title_async():
+        title = generate_chat_title(user_input)
+        ui_queue.post(lambda: handle_title_generated(title))
+
+    threading.Thread(target=generate_title_async, daemon=True).start()
+
 def handle_title_generated(title):
     if title and title != current_conversation["title"]:
         old_title = current_conversation["title"]
@@ -373,10 +2291,11 @@ def handle_title_generated(title):
             counter += 1
         try:
             current_conversation["title"] = title
+            chat_writer.cancel(old_title)
             if os.path.exists(old_path):
                 os.remove(old_path)
             save_current_conversation()
-            refresh_chat_list()
+            request_chat_list_refresh()
         except Exception as e:
             print(f"Error during rename: {e}")
             current_conversation["title"] = old_title
@@ -384,17 +2303,28 @@ def handle_title_generated(title):
     else:
         save_current_conversation()
 
-def handle_api_error(error_msg, original_cleaned_text):
+def handle_api_error(error_msg, original_cleaned_text, attachments=()):
     global is_processing
     
-    # Remove user message if API failed
+    # Remove user message (and any attachments sent with it) if API failed
     if current_conversation and current_conversation["messages"] and current_conversation["messages"][-1]["role"] == "user":
         current_conversation["messages"].pop()
+        while current_conversation["messages"] and "attachment" in current_conversation["messages"][-1]:
+            current_conversation["messages"].pop()
     
-    # Remove "Thinking..." message
-    output_box.config(state=tk.NORMAL)
-    output_box.delete("end-2l", "end-1c")
-    output_box.insert(tk.END, f"AI: Error - {error_msg}\n\n", "error")
+    # Keep the attachments for the retry
+    pending_attachments[:0] = attachments
+    update_attachments_label()
+    
+    # Remove "Thinking..." message, or end a reply that failed mid-stream
+    if reply_streaming:
+        finish_reply_stream()
+        output_box.config(state=tk.NORMAL)
+        output_box.insert(tk.END, f"\nAI: Error - {error_msg}\n\n", "error")
+    else:
+        output_box.config(state=tk.NORMAL)
+        output_box.delete("end-2l", "end-1c")
+        output_box.insert(tk.END, f"AI: Error - {error_msg}\n\n", "error")
     output_box.config(state=tk.DISABLED)
     
     # Re-enable controls first
@@ -410,6 +2340,53 @@ def handle_api_error(error_msg, original_cleaned_text):
     
     messagebox.showerror("API Error", error_msg)
 
+def attachment_placeholder(attachment):
+    return f"[Attached file: {attachment['name']} ({format_size(attachment['size'])})]"
+
+def update_attachments_label():
+    if pending_attachments:
+        names = ", ".join(attachment["name"] for attachment in pending_attachments)
+        attachments_label.config(text=f"Attached: {names} (click to remove)")
+    else:
+        attachments_label.config(text="")
+
+def clear_attachments(event=None):
+    pending_attachments.clear()
+    update_attachments_label()
+
+def attach_file():
+    """Pick a file to send with the next message; it is read and stored off the UI thread."""
+    path = filedialog.askopenfilename(
+        title="Attach File",
+        filetypes=[("Text and PDF files", "*.txt *.md *.csv *.json *.log *.py *.pdf"), ("All files", "*.*")]
+    )
+    if not path:
+        return
+    attach_button.config(state="disabled")
+    set_status(f"Reading {os.path.basename(path)}...", "blue", clear_after=None)
+
+    def prepare_async():
+        try:
+            attachment = prepare_attachment(path)
+        except Exception as e:
+            error_msg = str(e)
+            ui_queue.post(lambda: attachment_failed(error_msg))
+            return
+        ui_queue.post(lambda: attachment_ready(attachment))
+
+    threading.Thread(target=prepare_async, daemon=True).start()
+
+def attachment_ready(attachment):
+    attach_button.config(state="normal")
+    pending_attachments.append(attachment)
+    update_attachments_label()
+    set_status(f"Attached {attachment['name']} ({format_size(attachment['size'])})", "green")
+
+def attachment_failed(error_msg):
+    attach_button.config(state="normal")
+    set_status("", clear_after=None)
+    messagebox.showerror("Attach File", f"Failed to attach file: {error_msg}")
+
 def send_prompt():
     """Main send function that delegates to async version."""
     send_prompt_async()
@@ -424,32 +2401,104 @@ def clear_chat_box():
     output_box.delete("1.0", tk.END)
     output_box.config(state=tk.DISABLED)
 
-def save_current_conversation():
+_last_saved_signature = None
+
+def conversation_signature(conversation):
+    """Cheap fingerprint that changes whenever the app modifies a conversation."""
+    messages = conversation["messages"]
+    last = messages[-1] if messages else None
+    return (conversation["title"], len(messages), id(last), last.size if last else 0,
+            len(conversation.get("comparisons", ())))
+
+def save_current_conversation(immediate=False):
+    """Queue a save of the current conversation; unchanged conversations are skipped.
+
+    The write happens on chat_writer's thread and is coalesced with other
+    saves in the next SAVE_DELAY_MS. Pass immediate=True to write before returning.
+    """
+    global _last_saved_signature
     if not current_conversation or not current_conversation["messages"]:
         return
-    filename = os.path.join(CHAT_DIR, f"{current_conversation['title']}.json")
+    signature = conversation_signature(current_conversation)
+    if signature != _last_saved_signature:
+        _last_saved_signature = signature
+        chat_writer.schedule(copy_conversation_data(current_conversation))
+    if immediate:
+        chat_writer.flush()
+
+def on_conversation_saved(title, outcome, version, new_title):
+    """chat_writer callback: keep the current conversation in step with what was written."""
+    global _last_saved_signature
+    if not current_conversation or current_conversation["title"] != title:
+        return
+    if outcome == "saved":
+        current_conversation["version"] = version
+    elif outcome == "adopted" and not is_processing:
+        # Another instance already saved everything we have and more
+        load_conversation(os.path.join(CHAT_DIR, f"{title}.json"))
+        set_status("Chat updated by another window", "blue")
+    elif outcome == "conflict":
+        current_conversation.update(title=new_title, version=version)
+        _last_saved_signature = conversation_signature(current_conversation)
+        request_chat_list_refresh()
+        set_status(f"Chat was changed elsewhere; your copy was saved as {new_title}", "orange", clear_after=8000)
+
+def reload_if_changed_elsewhere(added, removed, modified):
+    """Watcher subscriber: pick up new messages another instance saved to the open chat."""
+    # An atomic rewrite (temp file renamed over the chat) is reported as "added"
+    if is_processing or not current_conversation or current_conversation["title"] not in added | modified:
+        return
+    path = os.path.join(CHAT_DIR, f"{current_conversation['title']}.json")
     try:
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(current_conversation, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error saving: {e}")
+        disk = conversation_cache.get(path)
+    except (OSError, ValueError):
+        return
+    ours = current_conversation["messages"]
+    if disk.get("version", 0) > current_conversation.get("version", 0) and disk.get("saved_by") != INSTANCE_ID \
+            and disk.get("messages", [])[:len(ours)] == ours:
+        load_conversation(path)
+        set_status("Chat updated by another window", "blue")
 
 def load_conversation(filename):
     global current_conversation
+    global _last_saved_signature
     try:
-        with open(filename, "r", encoding="utf-8") as f:
-            current_conversation = json.load(f)
+        current_conversation = copy_conversation_data(conversation_cache.get(filename))
+        _last_saved_signature = conversation_signature(current_conversation)
         clear_chat_box()
+        rendered_chars, render_seconds = 0, 0.0
+        output_box.config(state=tk.NORMAL)
         for msg in current_conversation["messages"]:
-            role = "user" if msg["role"] == "user" else "ai"
-            prefix = "You: " if role == "user" else "AI: "
-            output_box.config(state=tk.NORMAL)
-            output_box.insert(tk.END, prefix + msg["content"] + "\n\n", role)
-            output_box.config(state=tk.DISABLED)
+            if msg["role"] == "user":
+                output_box.insert(tk.END, "You: " + msg["content"] + "\n\n", "user")
+            else:
+                output_box.insert(tk.END, "AI: ", "ai")
+                reply_renderer.render(msg["content"], "ai")
+                output_box.insert(tk.END, "\n\n", "ai")
+                rendered_chars += reply_renderer.chars
+                render_seconds += reply_renderer.seconds
+        output_box.config(state=tk.DISABLED)
         output_box.see(tk.END)
+        report_render_throughput(rendered_chars, render_seconds)
     except Exception as e:
         messagebox.showerror("Error", f"Failed to load conversation: {e}")
 
+_status_clear_job = None
+
+def set_status(text, color="black", clear_after=3000):
+    """Show a status bar message, cleared after clear_after ms unless replaced first.
+
+    Call from the Tk thread; worker threads post a handler through ui_queue
+    that calls it (see attachment_ready).
+    """
+    global _status_clear_job
+    status_label.config(text=text, foreground=color)
+    if _status_clear_job is not None:
+        root.after_cancel(_status_clear_job)
+        _status_clear_job = None
+    if clear_after:
+        _status_clear_job = root.after(clear_after, lambda: set_status("", clear_after=None))
+
 def resize_input_box(event=None):
     lines = int(prompt_entry.index('end-1c').split('.')[0])
     # Reduce max height to prevent UI overflow
@@ -474,15 +2523,58 @@ def refresh_chat_list():
     except Exception as e:
         print(f"Error refreshing chat list: {e}")
 
+# Above this many adds/removes in one batch a full rebuild is cheaper than patching
+CHAT_LIST_REBUILD_THRESHOLD = 500
+
+def request_chat_list_refresh():
+    """Rebuild the chat list on the next UI frame; repeated requests merge into one."""
+    ui_queue.post(refresh_chat_list, key="chat_list")
+
+def _descending_insert_index(items, name):
+    """Binary search for where name belongs in the reverse-sorted chat list.
+
+    Compares file names rather than titles so the order matches refresh_chat_list.
+    """
+    key = name + ".json"
+    lo, hi = 0, len(items)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if items[mid] + ".json" > key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def apply_chat_list_changes(added, removed, modified):
+    """Patch chat_listbox in place for chats changed on disk by other programs."""
+    if not added and not removed:
+        return
+    if len(added) + len(removed) > CHAT_LIST_REBUILD_THRESHOLD:
+        request_chat_list_refresh()
+        return
+    items = list(chat_listbox.get(0, tk.END))
+    present = set(items)
+    for name in removed & present:
+        idx = items.index(name)
+        chat_listbox.delete(idx)
+        del items[idx]
+        present.discard(name)
+    for name in added - present:
+        idx = _descending_insert_index(items, name)
+        chat_listbox.insert(idx, name)
+        items.insert(idx, name)
+
 def on_chat_select(event):
     selections = chat_listbox.curselection()
     if len(selections) == 1 and not is_processing:  # Only load if single selection
         filename = chat_listbox.get(selections[0]) + ".json"
         load_conversation(os.path.join(CHAT_DIR, filename))
+        # Warm the cache with the chats above and below so stepping through the list is instant
+        neighbors = [i for i in (selections[0] - 1, selections[0] + 1) if 0 <= i < chat_listbox.size()]
+        conversation_cache.prefetch(os.path.join(CHAT_DIR, chat_listbox.get(i) + ".json") for i in neighbors)
     elif len(selections) > 1:
         # Show selection count in status
-        status_label.config(text=f"{len(selections)} chats selected", foreground="blue")
-        root.after(2000, lambda: status_label.config(text="", foreground="black"))
+        set_status(f"{len(selections)} chats selected", "blue", clear_after=2000)
 
 def rename_chat(event=None):
     selections = chat_listbox.curselection()
@@ -496,13 +2588,13 @@ def rename_chat(event=None):
         new_name = sanitize_filename(new_name)
         new_path = os.path.join(CHAT_DIR, f"{new_name}.json")
         try:
+            chat_writer.flush()  # make sure the file being renamed is complete
             os.rename(old_path, new_path)
             if current_conversation and current_conversation["title"] == old_name:
                 current_conversation["title"] = new_name
                 save_current_conversation()
-            refresh_chat_list()
-            status_label.config(text="Chat renamed successfully", foreground="green")
-            root.after(3000, lambda: status_label.config(text="", foreground="black"))
+            request_chat_list_refresh()
+            set_status("Chat renamed successfully", "green")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to rename: {e}")
 
@@ -524,6 +2616,7 @@ def delete_chat():
             for index in reversed(sorted(selections)):  # Delete in reverse order to maintain indices
                 chat_name = chat_listbox.get(index)
                 path = os.path.join(CHAT_DIR, f"{chat_name}.json")
+                chat_writer.cancel(chat_name)
                 if os.path.exists(path):
                     os.remove(path)
                 
@@ -536,13 +2629,12 @@ def delete_chat():
                 start_new_conversation()
                 clear_chat_box()
                 
-            refresh_chat_list()
+            request_chat_list_refresh()
             
             if len(selections) == 1:
-                status_label.config(text="Chat deleted successfully", foreground="green")
+                set_status("Chat deleted successfully", "green")
             else:
-                status_label.config(text=f"{len(selections)} chats deleted successfully", foreground="green")
-            root.after(3000, lambda: status_label.config(text="", foreground="black"))
+                set_status(f"{len(selections)} chats deleted successfully", "green")
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to delete chats: {e}")
@@ -569,20 +2661,15 @@ def export_chat():
         if filename:
             try:
                 path = os.path.join(CHAT_DIR, f"{chat_name}.json")
-                with open(path, "r", encoding="utf-8") as f:
-                    conversation = json.load(f)
+                conversation = conversation_cache.get(path)
                 
                 with open(filename, "w", encoding="utf-8") as f:
                     f.write(f"Chat: {chat_name}\n")
                     f.write(f"Exported: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
                     f.write("=" * 50 + "\n\n")
-                    
-                    for msg in conversation["messages"]:
-                        role = "You" if msg["role"] == "user" else "AI"
-                        f.write(f"{role}: {msg['content']}\n\n")
+                    f.writelines(iter_transcript(conversation["messages"]))
                 
-                status_label.config(text=f"Chat exported to {os.path.basename(filename)}", foreground="green")
-                root.after(3000, lambda: status_label.config(text="", foreground="black"))
+                set_status(f"Chat exported to {os.path.basename(filename)}", "green")
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to export: {e}")
     
@@ -595,9 +2682,7 @@ def export_chat():
                 for selection in selections:
                     chat_name = chat_listbox.get(selection)
                     path = os.path.join(CHAT_DIR, f"{chat_name}.json")
-                    
-                    with open(path, "r", encoding="utf-8") as f:
-                        conversation = json.load(f)
+                    conversation = conversation_cache.get(path)
                     
                     # Sanitize filename for export
                     safe_name = re.sub(r'[<>:"/\\|?*]', '_', chat_name)
@@ -607,15 +2692,11 @@ def export_chat():
                         f.write(f"Chat: {chat_name}\n")
                         f.write(f"Exported: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
                         f.write("=" * 50 + "\n\n")
-                        
-                        for msg in conversation["messages"]:
-                            role = "You" if msg["role"] == "user" else "AI"
-                            f.write(f"{role}: {msg['content']}\n\n")
+                        f.writelines(iter_transcript(conversation["messages"]))
                     
                     exported_count += 1
                 
-                status_label.config(text=f"{exported_count} chats exported to {os.path.basename(folder)}", foreground="green")
-                root.after(3000, lambda: status_label.config(text="", foreground="black"))
+                set_status(f"{exported_count} chats exported to {os.path.basename(folder)}", "green")
                 
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to export chats: {e}")
@@ -625,17 +2706,385 @@ def copy_conversation():
     if not current_conversation or not current_conversation["messages"]:
         return
     
-    text = f"Chat: {current_conversation['title']}\n"
-    text += "=" * 50 + "\n\n"
-    
-    for msg in current_conversation["messages"]:
-        role = "You" if msg["role"] == "user" else "AI"
-        text += f"{role}: {msg['content']}\n\n"
+    header = f"Chat: {current_conversation['title']}\n" + "=" * 50 + "\n\n"
+    text = "".join([header, *iter_transcript(current_conversation["messages"])])
     
     root.clipboard_clear()
     root.clipboard_append(text)
-    status_label.config(text="Conversation copied to clipboard!", foreground="green")
-    root.after(3000, lambda: status_label.config(text="", foreground="black"))
+    set_status("Conversation copied to clipboard!", "green")
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """Estimated USD cost of a call, or None if the model has no MODEL_PRICING entry."""
+    prices = MODEL_PRICING.get(model)
+    if not prices:
+        return None
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000
+
+def stream_compare_reply(model, messages, on_delta, on_done, cancelled):
+    """Stream one model's reply for compare mode. Runs on a worker thread.
+
+    on_delta(text) is called for every chunk and on_done(stats, reply, error)
+    exactly once when the stream ends, fails or is cancelled. Attachments in
+    messages are expanded here, off the Tk thread.
+    """
+    stats = {"model": model, "queued": None, "first_token": None, "latency": None,
+             "prompt_tokens": None, "completion_tokens": None, "cost": None}
+    parts = []
+    try:
+        messages = to_api_messages(messages)
+        ticket = api_scheduler.acquire(model, estimate_tokens(messages), PRIORITY_INTERACTIVE)
+        stats["queued"] = ticket.waited
+        start = time.perf_counter()
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        for chunk in stream:
+            if cancelled.is_set():
+                stream.close()
+                break
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if stats["first_token"] is None:
+                        stats["first_token"] = time.perf_counter() - start
+                    parts.append(delta)
+                    on_delta(delta)
+            # The final chunk carries usage for the whole request and no choices
+            if getattr(chunk, "usage", None):
+                stats["prompt_tokens"] = chunk.usage.prompt_tokens
+                stats["completion_tokens"] = chunk.usage.completion_tokens
+                ticket.settle(chunk.usage.total_tokens)
+    except Exception as e:
+        on_done(stats, "".join(parts), str(e))
+        return
+    stats["latency"] = time.perf_counter() - start
+    if stats["prompt_tokens"] is not None:
+        stats["cost"] = estimate_cost(model, stats["prompt_tokens"], stats["completion_tokens"])
+    on_done(stats, "".join(parts), None)
+
+def format_compare_stats(stats):
+    parts = []
+    if stats["queued"]:
+        parts.append(f"Queued {stats['queued']:.2f}s")
+    if stats["first_token"] is not None:
+        parts.append(f"First token {stats['first_token']:.2f}s")
+    if stats["latency"] is not None:
+        parts.append(f"Total {stats['latency']:.2f}s")
+    if stats["prompt_tokens"] is not None:
+        parts.append(f"Tokens {stats['prompt_tokens']} in / {stats['completion_tokens']} out")
+    if stats["cost"] is not None:
+        parts.append(f"${stats['cost']:.4f}")
+    return " | ".join(parts)
+
+def keep_compared_answer(prompt, reply, kept_model, all_stats):
+    """Add the chosen compare-mode answer to the current conversation."""
+    if not current_conversation:
+        start_new_conversation()
+    current_conversation["messages"].append(Message("user", prompt))
+    current_conversation["messages"].append(Message("assistant", reply))
+    current_conversation.setdefault("comparisons", []).append({
+        "prompt": prompt,
+        "kept": kept_model,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "results": all_stats
+    })
+
+    output_box.config(state=tk.NORMAL)
+    output_box.insert(tk.END, f"You: {prompt}\n", "user")
+    output_box.insert(tk.END, f"AI ({kept_model}): ", "ai")
+    reply_renderer.render(reply, "ai")
+    output_box.insert(tk.END, "\n\n", "ai")
+    output_box.config(state=tk.DISABLED)
+    output_box.see(tk.END)
+
+    user_count = sum(1 for m in current_conversation["messages"] if m.get("role") == "user")
+    if user_count == 1:
+        start_title_generation(prompt)
+    else:
+        save_current_conversation()
+        request_chat_list_refresh()
+
+def open_compare_window():
+    """Send one prompt to several models at once and show the replies side by side."""
+    if not check_api_key_on_send():
+        return
+
+    window = tk.Toplevel(root)
+    window.title("Compare Models")
+    window.geometry("1200x700")
+    cancelled = threading.Event()
+
+    def on_close():
+        cancelled.set()
+        window.destroy()
+
+    window.protocol("WM_DELETE_WINDOW", on_close)
+
+    top_frame = ttk.Frame(window)
+    top_frame.pack(fill=tk.X, padx=10, pady=(10, 5))
+    ttk.Label(top_frame, text="Models:", font=("Arial", 10, "bold")).pack(side=tk.LEFT)
+    model_checks = {}
+    for model in models:
+        var = tk.BooleanVar(value=(model == model_var.get()))
+        ttk.Checkbutton(top_frame, text=model, variable=var).pack(side=tk.LEFT, padx=(8, 0))
+        model_checks[model] = var
+
+    prompt_frame = ttk.LabelFrame(window, text="Prompt")
+    prompt_frame.pack(fill=tk.X, padx=10)
+    compare_prompt = scrolledtext.ScrolledText(prompt_frame, wrap=tk.WORD, height=4, font=("Arial", 10), borderwidth=1, relief='solid')
+    compare_prompt.pack(fill=tk.X, padx=2, pady=2)
+    compare_prompt.insert("1.0", prompt_entry.get("1.0", "end-1c"))
+
+    results_frame = ttk.Frame(window)
+    results_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+    results_frame.rowconfigure(0, weight=1)
+
+    # State of the current run, shared by the callbacks below
+    run = {"prompt": "", "panes": {}, "results": {}, "remaining": 0}
+
+    def append_delta(model, text):
+        if not window.winfo_exists():
+            return
+        box = run["panes"][model]["box"]
+        box.config(state=tk.NORMAL)
+        box.insert(tk.END, text)
+        box.config(state=tk.DISABLED)
+        box.see(tk.END)
+
+    def finish_model(model, stats, reply, error):
+        if not window.winfo_exists():
+            return
+        pane = run["panes"][model]
+        if error:
+            pane["stats"].config(text=f"Error - {error}", foreground="red")
+        else:
+            run["results"][model] = {"reply": reply, "stats": stats}
+            pane["stats"].config(text=format_compare_stats(stats))
+            if reply:
+                pane["keep"].config(state="normal")
+        run["remaining"] -= 1
+        if run["remaining"] == 0:
+            run_button.config(state="normal")
+
+    def keep_answer(model):
+        if is_processing:
+            messagebox.showinfo("Compare Models", "Wait for the current reply to finish first.", parent=window)
+            return
+        all_stats = [result["stats"] for result in run["results"].values()]
+        keep_compared_answer(run["prompt"], run["results"][model]["reply"], model, all_stats)
+        on_close()
+
+    def run_comparison():
+        selected = [model for model, var in model_checks.items() if var.get()]
+        prompt = clean_text_aggressive(compare_prompt.get("1.0", tk.END))
+        if not prompt or not selected:
+            messagebox.showwarning("Compare Models", "Enter a prompt and select at least one model.", parent=window)
+            return
+
+        for child in results_frame.winfo_children():
+            child.destroy()
+        run.update(prompt=prompt, panes={}, results={}, remaining=len(selected))
+        run_button.config(state="disabled")
+
+        for col, model in enumerate(selected):
+            results_frame.columnconfigure(col, weight=1, uniform="compare")
+            pane_frame = ttk.LabelFrame(results_frame, text=model)
+            pane_frame.grid(row=0, column=col, sticky="nsew", padx=3)
+            box = scrolledtext.ScrolledText(pane_frame, wrap=tk.WORD, width=30, state=tk.DISABLED, font=("Arial", 10), borderwidth=1, relief='solid')
+            box.pack(fill=tk.BOTH, expand=True, padx=2, pady=2)
+            stats_text = ttk.Label(pane_frame, text="Waiting for reply...", font=("Arial", 8))
+            stats_text.pack(fill=tk.X, padx=2)
+            keep_button = ttk.Button(pane_frame, text="Keep this answer", state="disabled", command=lambda m=model: keep_answer(m))
+            keep_button.pack(pady=(2, 4))
+            run["panes"][model] = {"box": box, "stats": stats_text, "keep": keep_button}
+
+        history = list(current_conversation["messages"]) if current_conversation else []
+        messages = history + [{"role": "user", "content": prompt}]
+        for model in selected:
+            def on_delta(text, model=model):
+                ui_queue.post_append((id(window), model), lambda chunk: append_delta(model, chunk), text)
+
+            def on_done(stats, reply, error, model=model):
+                ui_queue.post(lambda: finish_model(model, stats, reply, error))
+
+            threading.Thread(
+                target=stream_compare_reply,
+                args=(model, messages, on_delta, on_done, cancelled),
+                daemon=True
+            ).start()
+
+    run_button = ttk.Button(top_frame, text="Compare", command=run_comparison)
+    run_button.pack(side=tk.RIGHT)
+
+def semantic_index_enabled():
+    return np is not None and semantic_index_var.get()
+
+def index_all_chats():
+    """Queue every chat for indexing; chats unchanged since last time are skipped."""
+    index = get_semantic_index()
+    try:
+        for file in os.listdir(CHAT_DIR):
+            if file.endswith(".json"):
+                index.enqueue(file[:-5])
+    except Exception as e:
+        print(f"Error queueing chats for indexing: {e}")
+
+def toggle_semantic_index():
+    if not semantic_index_var.get():
+        return
+    if np is None:
+        semantic_index_var.set(False)
+        messagebox.showwarning("Semantic Index", "The semantic index needs NumPy.\n\nInstall it with: pip install numpy")
+        return
+    if get_semantic_index() is None:
+        semantic_index_var.set(False)
+        messagebox.showwarning("Semantic Index", "Another window is using the semantic index.\n\n"
+                               "Use semantic search there, or close it and turn the index on here.")
+        return
+    index_all_chats()
+    set_status("Indexing chats in the background...", "blue")
+
+def update_semantic_index(added, removed, modified):
+    """Keep the index in step with chats changed on disk (watcher subscriber)."""
+    if not semantic_index_enabled():
+        return
+    index = get_semantic_index()
+    for title in removed:
+        index.enqueue(title, None)
+    for title in added | modified:
+        index.enqueue(title)
+
+def build_request_messages(messages, query, index):
+    """Messages to send for a turn, with related excerpts from other chats.
+
+    index is the SemanticIndex when "Use related chats" is ticked, else None.
+    The best semantic matches are then prepended as a system message; they are
+    sent with this request only, never saved. Runs on a worker thread.
+    """
+    if index is None:
+        return messages
+    try:
+        results = index.search(query, k=CONTEXT_SNIPPETS, exclude_chat=current_conversation["title"],
+                               priority=PRIORITY_INTERACTIVE)
+    except Exception as e:
+        print(f"Semantic search failed: {e}")
+        return messages
+    excerpts = []
+    for result in results:
+        text = index.message_text(result)
+        if text:
+            excerpts.append(f"[{result['chat']}] {result['role']}: {text[:SNIPPET_CHARS]}")
+    if not excerpts:
+        return messages
+    context = ("Relevant excerpts from the user's earlier conversations. Use them only if they help.\n\n"
+               + "\n\n".join(excerpts))
+    return [{"role": "system", "content": context}] + list(messages)
+
+def open_semantic_search():
+    """Search past chats by meaning and open a hit or paste it into the prompt."""
+    if np is None:
+        messagebox.showwarning("Semantic Search", "Semantic search needs NumPy.\n\nInstall it with: pip install numpy")
+        return
+    if not semantic_index_var.get():
+        if not messagebox.askyesno("Semantic Search", "The semantic index is off.\n\nTurn it on and index your chats now?"):
+            return
+        semantic_index_var.set(True)
+        toggle_semantic_index()
+        if not semantic_index_var.get():
+            return
+    index = get_semantic_index()
+
+    dialog = tk.Toplevel(root)
+    dialog.title("Semantic Search")
+    dialog.geometry("750x450")
+    dialog.transient(root)
+
+    query_frame = ttk.Frame(dialog)
+    query_frame.pack(fill=tk.X, padx=10, pady=10)
+    query_var = tk.StringVar()
+    query_entry = ttk.Entry(query_frame, textvariable=query_var)
+    query_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+    search_button = ttk.Button(query_frame, text="Search")
+    search_button.pack(side=tk.LEFT, padx=(5, 0))
+
+    results_listbox = tk.Listbox(dialog, font=("Arial", 9))
+    results_listbox.pack(fill=tk.BOTH, expand=True, padx=10)
+    search_status = ttk.Label(dialog, text="", font=("Arial", 8))
+    search_status.pack(fill=tk.X, padx=10)
+
+    button_frame = ttk.Frame(dialog)
+    button_frame.pack(fill=tk.X, padx=10, pady=10)
+    hits = []
+
+    def show_results(found, error=None):
+        if not dialog.winfo_exists():
+            return
+        search_button.config(state="normal")
+        if error:
+            search_status.config(text=f"Search failed: {error}", foreground="red")
+            return
+        hits[:] = found
+        results_listbox.delete(0, tk.END)
+        for result, text in found:
+            snippet = " ".join(text.split())[:120]
+            results_listbox.insert(tk.END, f"{result['score']:.2f}  {result['chat']} - {result['role']}: {snippet}")
+        search_status.config(text=f"{len(found)} matches", foreground="black")
+
+    def do_search(event=None):
+        query = query_var.get().strip()
+        if not query:
+            return
+        search_button.config(state="disabled")
+        search_status.config(text="Searching...", foreground="blue")
+
+        def search_async():
+            try:
+                results = index.search(query, k=20, priority=PRIORITY_INTERACTIVE)
+                found = [(result, index.message_text(result)) for result in results]
+                found = [(result, text) for result, text in found if text]
+            except Exception as e:
+                error = str(e)
+                ui_queue.post(lambda: show_results([], error))
+                return
+            ui_queue.post(lambda: show_results(found))
+
+        threading.Thread(target=search_async, daemon=True).start()
+
+    def selected_hit():
+        selection = results_listbox.curselection()
+        return hits[selection[0]] if selection else None
+
+    def open_hit(event=None):
+        hit = selected_hit()
+        if not hit or is_processing:
+            return
+        title = hit[0]["chat"]
+        load_conversation(os.path.join(CHAT_DIR, f"{title}.json"))
+        items = list(chat_listbox.get(0, tk.END))
+        if title in items:
+            idx = items.index(title)
+            chat_listbox.selection_clear(0, tk.END)
+            chat_listbox.selection_set(idx)
+            chat_listbox.see(idx)
+
+    def insert_hit():
+        hit = selected_hit()
+        if not hit:
+            return
+        result, text = hit
+        prompt_entry.insert(tk.INSERT, f"Context from \"{result['chat']}\":\n{text[:SNIPPET_CHARS]}\n\n")
+        resize_input_box()
+
+    search_button.config(command=do_search)
+    query_entry.bind("<Return>", do_search)
+    results_listbox.bind("<Double-Button-1>", open_hit)
+    ttk.Button(button_frame, text="Open Chat", command=open_hit).pack(side=tk.LEFT)
+    ttk.Button(button_frame, text="Insert into Prompt", command=insert_hit).pack(side=tk.LEFT, padx=(10, 0))
+    ttk.Button(button_frame, text="Close", command=dialog.destroy).pack(side=tk.RIGHT)
+    query_entry.focus_set()
 
 def on_enter(event):
     if event.state & 0x0001:  # Shift key pressed
@@ -652,7 +3101,8 @@ def autosave_conversation():
     root.after(5000, autosave_conversation)
 
 def on_window_close():
-    save_current_conversation()
+    save_current_conversation(immediate=True)
+    chat_dir_watcher.stop()
     root.destroy()
 
 is_dark_mode = False
@@ -689,12 +3139,15 @@ def toggle_theme():
         
         # Text widgets
         output_box.config(bg='#1e1e1e', fg='white', insertbackground='white', highlightbackground='#404040', highlightcolor='#505050', selectbackground='#404040', selectforeground='white')
+        output_box.tag_config("md_code", foreground="#d4d4d4", background="#2d2d2d")
+        output_box.tag_config("md_inline_code", background="#2d2d2d")
         prompt_entry.config(bg='#1e1e1e', fg='white', insertbackground='white', highlightbackground='#404040', highlightcolor='#505050', selectbackground='#404040', selectforeground='white')
         chat_listbox.config(bg='#1e1e1e', fg='white', selectbackground='#404040', selectforeground='white', highlightbackground='#404040')
         
         # Menu styling
         menubar.config(bg='#404040', fg='white', activebackground='#505050', activeforeground='white', borderwidth=0)
         settings_menu.config(bg='#404040', fg='white', activebackground='#505050', activeforeground='white', borderwidth=0)
+        diagnostics_menu.config(bg='#404040', fg='white', activebackground='#505050', activeforeground='white', borderwidth=0)
         
         # Context menu styling
         chat_menu.config(bg='#404040', fg='white', activebackground='#505050', activeforeground='white', borderwidth=0)
@@ -713,12 +3166,15 @@ def toggle_theme():
         
         # Reset text widgets to light mode
         output_box.config(bg='white', fg='black', insertbackground='black', highlightbackground='SystemButtonFace', highlightcolor='SystemHighlight', selectbackground='SystemHighlight', selectforeground='SystemHighlightText')
+        output_box.tag_config("md_code", foreground="black", background="#f4f4f4")
+        output_box.tag_config("md_inline_code", background="#f0f0f0")
         prompt_entry.config(bg='white', fg='black', insertbackground='black', highlightbackground='SystemButtonFace', highlightcolor='SystemHighlight', selectbackground='SystemHighlight', selectforeground='SystemHighlightText')
         chat_listbox.config(bg='white', fg='black', selectbackground='SystemHighlight',selectforeground='SystemHighlightText', highlightbackground='SystemButtonFace')
         
         # Reset menu styling
         menubar.config(bg='SystemMenu', fg='SystemMenuText', activebackground='SystemHighlight', activeforeground='SystemHighlightText')
         settings_menu.config(bg='SystemMenu', fg='SystemMenuText', activebackground='SystemHighlight', activeforeground='SystemHighlightText')
+        diagnostics_menu.config(bg='SystemMenu', fg='SystemMenuText', activebackground='SystemHighlight', activeforeground='SystemHighlightText')
         
         # Reset context menu
         chat_menu.config(bg='SystemMenu', fg='SystemMenuText', activebackground='SystemHighlight', activeforeground='SystemHighlightText')
@@ -726,6 +3182,37 @@ def toggle_theme():
         root.title("OpenAI Chat Client")
         theme_button.config(text="🌙 Dark Mode")
 
+def toggle_profiler():
+    diagnostics.toggle_profiler(profiler_var.get())
+    set_status("Profiling main thread..." if profiler_var.get() else "Profiler stopped", "blue")
+
+def take_memory_snapshot():
+    count, current, peak = diagnostics.take_snapshot()
+    set_status(f"Memory snapshot {count}: {current / 1e6:.1f} MB traced (peak {peak / 1e6:.1f} MB)", "blue")
+
+def toggle_loop_monitor():
+    diagnostics.toggle_monitor(loop_monitor_var.get())
+    set_status("Monitoring event loop lag..." if loop_monitor_var.get() else "Loop monitor stopped", "blue")
+
+def save_diagnostics_report():
+    folder = filedialog.askdirectory(title="Select folder for the diagnostics report")
+    if not folder:
+        return
+    try:
+        bundle = diagnostics.save_report(folder)
+        set_status(f"Diagnostics saved to {bundle.name}", "green")
+    except Exception as e:
+        messagebox.showerror("Error", f"Failed to save diagnostics: {e}")
+
+def update_queue_status():
+    """Show how many API requests are held back by the client-side rate limits."""
+    waiting, longest = api_scheduler.queue_state()
+    if waiting:
+        queue_label.config(text=f"API queue: {waiting} waiting ({longest:.1f}s)", foreground="orange")
+    else:
+        queue_label.config(text="")
+    root.after(500, update_queue_status)
+
 def update_text_stats():
     """Update word and character count for the input field"""
     text = prompt_entry.get("1.0", tk.END).strip()
@@ -754,6 +3241,22 @@ settings_menu.add_command(label="Set API Key...", command=set_api_key)
 settings_menu.add_separator()
 settings_menu.add_command(label="Toggle Dark Mode", command=toggle_theme)
 settings_menu.add_separator()
+semantic_index_var = tk.BooleanVar(value=os.getenv("CHAT_SEMANTIC_INDEX") == "1" and np is not None)
+settings_menu.add_checkbutton(label="Semantic Index", variable=semantic_index_var, command=toggle_semantic_index)
+settings_menu.add_command(label="Semantic Search...", command=open_semantic_search)
+settings_menu.add_separator()
+
+# Diagnostics submenu
+diagnostics_menu = tk.Menu(settings_menu, tearoff=0)
+settings_menu.add_cascade(label="Diagnostics", menu=diagnostics_menu)
+profiler_var = tk.BooleanVar(value=False)
+loop_monitor_var = tk.BooleanVar(value=False)
+diagnostics_menu.add_checkbutton(label="Profile Main Thread", variable=profiler_var, command=toggle_profiler)
+diagnostics_menu.add_command(label="Take Memory Snapshot", command=take_memory_snapshot)
+diagnostics_menu.add_checkbutton(label="Monitor Event Loop Lag", variable=loop_monitor_var, command=toggle_loop_monitor)
+diagnostics_menu.add_separator()
+diagnostics_menu.add_command(label="Save Diagnostics Report...", command=save_diagnostics_report)
+settings_menu.add_separator()
 settings_menu.add_command(label="About", command=lambda: messagebox.showinfo("About", "OpenAI Chat Client\n\nA simple GUI for chatting with OpenAI models.\n\nRequires OpenAI API key to function.\n\nFeatures:\n• Dark/Light mode\n• Chat history\n• Export conversations\n• Auto-save"))
 
 # Check API key on startup
@@ -860,6 +3363,14 @@ copy_button.grid(row=0, column=3, padx=5)
 clear_button = ttk.Button(controls_frame, text="Clear", command=clear_chat_box)
 clear_button.grid(row=0, column=4, padx=5)
 
+compare_button = ttk.Button(controls_frame, text="Compare Models...", command=open_compare_window)
+compare_button.grid(row=0, column=5, padx=5)
+
+# Prepend related excerpts from other chats (semantic index) to each request
+context_var = tk.BooleanVar(value=False)
+context_check = ttk.Checkbutton(controls_frame, text="Use related chats", variable=context_var)
+context_check.grid(row=0, column=6, padx=5)
+
 # Output area with frame
 output_frame = ttk.LabelFrame(right_frame, text="Conversation")
 output_frame.pack(fill=tk.BOTH, expand=True, padx=2, pady=2)
@@ -873,6 +3384,23 @@ output_box.tag_config("ai", foreground="green", font=("Arial", 10))
 output_box.tag_config("thinking", foreground="gray", font=("Arial", 10, "italic"))
 output_box.tag_config("error", foreground="red", font=("Arial", 10))
 
+# Markdown tags (configured after "ai" so their fonts and colours take precedence)
+output_box.tag_config("md_h1", font=("Arial", 16, "bold"))
+output_box.tag_config("md_h2", font=("Arial", 14, "bold"))
+output_box.tag_config("md_h3", font=("Arial", 12, "bold"))
+output_box.tag_config("md_bold", font=("Arial", 10, "bold"))
+output_box.tag_config("md_italic", font=("Arial", 10, "italic"))
+output_box.tag_config("md_list", lmargin1=15, lmargin2=30)
+output_box.tag_config("md_quote", foreground="gray", lmargin1=15, lmargin2=15)
+output_box.tag_config("md_inline_code", font=("Courier", 10), background="#f0f0f0")
+output_box.tag_config("md_code", font=("Courier", 10), foreground="black", background="#f4f4f4", lmargin1=10, lmargin2=10)
+output_box.tag_config("syn_keyword", foreground="#0000cc")
+output_box.tag_config("syn_string", foreground="#a31515")
+output_box.tag_config("syn_comment", foreground="#008000")
+output_box.tag_config("syn_number", foreground="#098658")
+
+reply_renderer = MarkdownRenderer(output_box)
+
 input_frame = ttk.LabelFrame(right_frame, text="Your Message")
 input_frame.pack(fill=tk.X, padx=2, pady=2)
 
@@ -896,15 +3424,39 @@ ttk.Label(bottom_frame, text="Press Enter to send, Shift+Enter for new line", fo
 send_button = ttk.Button(bottom_frame, text="Send", command=send_prompt)
 send_button.pack(side=tk.RIGHT, ipadx=15, ipady=3)
 
+attach_button = ttk.Button(bottom_frame, text="Attach File...", command=attach_file)
+attach_button.pack(side=tk.RIGHT, padx=(0, 5), ipady=3)
+
+# Files waiting to be sent with the next message
+attachments_label = ttk.Label(input_frame, text="", font=("Arial", 8), foreground="blue", cursor="hand2")
+attachments_label.pack(fill=tk.X, padx=2, before=bottom_frame)
+attachments_label.bind("<Button-1>", clear_attachments)
+
+# Requests waiting on the client-side rate limiter
+queue_label = ttk.Label(bottom_frame, text="", font=("Arial", 8))
+queue_label.pack(side=tk.RIGHT, padx=(0, 10))
+
 # Status bar
 status_label = ttk.Label(right_frame, text="", font=("Arial", 8))
 status_label.pack(side=tk.BOTTOM, fill=tk.X, padx=2)
 
 # Initialize
 refresh_chat_list()
+ui_queue.start(root)
+chat_writer = ChatWriter(CHAT_DIR, on_saved=on_conversation_saved)
+diagnostics = Diagnostics(root, ui_queue)
+chat_dir_watcher = ChatDirWatcher(CHAT_DIR, schedule=ui_queue.post_later)
+chat_dir_watcher.subscribe(conversation_cache.on_chat_changes)
+chat_dir_watcher.subscribe(apply_chat_list_changes)
+chat_dir_watcher.subscribe(reload_if_changed_elsewhere)
+chat_dir_watcher.subscribe(update_semantic_index)
+chat_dir_watcher.start()
+if semantic_index_enabled():
+    toggle_semantic_index()  # checks this window can own the index, then indexes
 start_new_conversation()
 autosave_conversation()
 update_text_stats()  # Start text stats updates
+update_queue_status()
 prompt_entry.focus_set()
 
 root.mainloop()